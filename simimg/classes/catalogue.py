@@ -0,0 +1,134 @@
+""" Compact store of the information about all loaded files.
+
+Every unique checksum gets an integer row and every file an integer file
+id. The properties of the images and their hash values are kept in typed
+arrays indexed by row, the files in arrays indexed by file id with their
+folder names interned. The FileObjects are only small views on this.
+
+Measured with tracemalloc for 100k files with a "HSV (5 regions)" and a
+"Horizontal" hash each, including the FODict, thumbnails excluded:
+    FileObject with attributes and hashDict: ~1.2 kB per file
+    Catalogue plus slotted FileObject: ~0.4 kB per file
+"""
+import os
+from array import array
+
+# timestamp used for pictures without a date
+MISSINGDATE = -(2**63)
+
+
+class Catalogue():
+    " Columnar store of the files and the properties of their checksums "
+
+    def __init__(self):
+        # rows: one for each unique checksum
+        self.checksums = []
+        self._rows = {}
+        self.widths = array("l")
+        self.heights = array("l")
+        self.timestamps = array("q")
+        # camera models are interned, 0 is the empty (missing) model
+        self.models = array("l")
+        self.modelNames = [""]
+        self._modelIds = {"": 0}
+        self.thumbnails = []
+        # hashName: [values (width per row), row has value flags, width]
+        self._hashes = {}
+        # hashName: rows for which the hash cannot be calculated
+        self._failedHashes = {}
+
+        # files
+        self.fileDirs = array("l")
+        self.fileNames = []
+        self.fileRows = array("l")
+        self.fileActive = bytearray()
+        # folder names are interned
+        self.dirNames = []
+        self._dirIds = {}
+
+    def __len__(self):
+        return len(self.checksums)
+
+    def row(self, checksum):
+        return self._rows[checksum]
+
+    def rows(self, checksums):
+        return [self._rows[c] for c in checksums]
+
+    def _addRow(self, checksum, probe):
+        dummy, (width, height), make, model, timestamp = probe
+        row = len(self.checksums)
+        self.checksums.append(checksum)
+        self._rows[checksum] = row
+        self.widths.append(width)
+        self.heights.append(height)
+        self.timestamps.append(MISSINGDATE if timestamp is None else timestamp)
+        if model not in self._modelIds:
+            self._modelIds[model] = len(self.modelNames)
+            self.modelNames.append(model)
+        self.models.append(self._modelIds[model])
+        self.thumbnails.append(None)
+        return row
+
+    def addFile(self, fullPath, checksum, probe):
+        """ add a file with its checksum and probeImage record
+        and return its file id """
+        row = self._rows.get(checksum)
+        if row is None:
+            row = self._addRow(checksum, probe)
+
+        dirName, fileName = os.path.split(fullPath)
+        if dirName not in self._dirIds:
+            self._dirIds[dirName] = len(self.dirNames)
+            self.dirNames.append(dirName)
+
+        fileId = len(self.fileRows)
+        self.fileDirs.append(self._dirIds[dirName])
+        self.fileNames.append(fileName)
+        self.fileRows.append(row)
+        self.fileActive.append(1)
+        return fileId
+
+    def filePath(self, fileId):
+        return os.path.join(self.dirNames[self.fileDirs[fileId]], self.fileNames[fileId])
+
+    def _hashStore(self, hashName, width):
+        if hashName not in self._hashes:
+            self._hashes[hashName] = [array("B"), bytearray(), width]
+        store = self._hashes[hashName]
+        # make room for the rows that were added since
+        missing = len(self.checksums) - len(store[1])
+        if missing > 0:
+            store[0].frombytes(bytes(missing*store[2]))
+            store[1].extend(bytes(missing))
+        return store
+
+    def setHash(self, hashName, row, value):
+        values, present, width = self._hashStore(hashName, len(value))
+        values[row*width:(row+1)*width] = array("B", value)
+        present[row] = 1
+
+    def hasHash(self, hashName, row):
+        if hashName not in self._hashes:
+            return False
+        present = self._hashes[hashName][1]
+        return row < len(present) and present[row] == 1
+
+    def setHashFailed(self, hashName, row):
+        "remember that the hash of row cannot be calculated"
+        self._failedHashes.setdefault(hashName, set()).add(row)
+
+    def hashFailed(self, hashName, row):
+        return row in self._failedHashes.get(hashName, ())
+
+    def hash(self, hashName, row):
+        values, dummy, width = self._hashes[hashName]
+        return values[row*width:(row+1)*width]
+
+    def hashValues(self, hashName):
+        """return all the values of a hash (width bytes per row
+        in one array) and the width, nothing when no row has it"""
+        if hashName not in self._hashes:
+            return array("B"), 0
+        values, dummy, width = self._hashes[hashName]
+        return values, width
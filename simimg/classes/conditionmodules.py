@@ -6,15 +6,23 @@
     A method to do something when _somethingChanged
     A method to determine which imagepairs from a list of pairs match
 """
-import functools
+import bisect
+import heapq
 import itertools
 import math
 import tkinter as tk
-from operator import add
 from tkinter import ttk
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import simimg.classes.catalogue as CAT
 import simimg.classes.customscales as CS
+import simimg.classes.hammingindex as HI
 import simimg.classes.tooltip as TT
+import simimg.utils.handyfunctions as HF
 
 
 class ConditionModule(ttk.Frame):
@@ -34,7 +42,6 @@ class ConditionModule(ttk.Frame):
         self.mustMatch = tk.BooleanVar()
 
         self._currentMatchingGroups = {}
-        self._matchingInfo = []
         self._checksums = {}
 
         header_frame = ttk.Frame(self)
@@ -118,7 +125,7 @@ class ConditionModule(ttk.Frame):
             self._currentConfig[param] = getattr(self, param)
         return True
 
-    def _theymatch(self, checksumA, checksumB):
+    def _theymatch(self, rowA, rowB):
         pass
 
     def _preMatching(self):
@@ -127,12 +134,30 @@ class ConditionModule(ttk.Frame):
     def _postMatching(self):
         pass
 
-    def _getMatchingGroups(self):
-        cand = list(itertools.combinations(self._checksums, 2))
-        matches = [(a, b) for a, b in cand if self._theymatch(a, b)]
-        # make a dict with:
-        # for each checksum that has matches the set of matching checksums
-        # we include the checksum itself
+    def _matchingPairs(self, rows):
+        "return the pairs of catalogue rows that match"
+        cand = itertools.combinations(rows, 2)
+        return [(a, b) for a, b in cand if self._theymatch(a, b)]
+
+    @staticmethod
+    def _windowPairs(rows, key, width):
+        """return the pairs of rows of which the key differs at most width
+        by sweeping over the rows sorted by key"""
+        rows = sorted(rows, key=key)
+        keys = [key(row) for row in rows]
+        pairs = []
+        for i, keyA in enumerate(keys):
+            j = i + 1
+            while j < len(keys) and keys[j] - keyA <= width:
+                pairs.append((rows[i], rows[j]))
+                j += 1
+        return pairs
+
+    @staticmethod
+    def _groupsFromPairs(matches):
+        """make a dict with:
+        for each checksum that has matches the set of matching checksums
+        we include the checksum itself"""
         matchingGroupsDict = {}
         for a, b in matches:
             if a not in matchingGroupsDict:
@@ -141,7 +166,17 @@ class ConditionModule(ttk.Frame):
             if b not in matchingGroupsDict:
                 matchingGroupsDict[b] = {b}
             matchingGroupsDict[b].add(a)
-        self._currentMatchingGroups = matchingGroupsDict
+        return matchingGroupsDict
+
+    def _getMatchingGroups(self):
+        # compare the rows of the checksums in the catalogue
+        cat = self._Ctrl.Catalogue
+        rows = cat.rows(self._checksums)
+        matches = [
+            (cat.checksums[a], cat.checksums[b])
+            for a, b in self._matchingPairs(rows)
+        ]
+        self._currentMatchingGroups = self._groupsFromPairs(matches)
 
     def matchingGroups(self, checksums):
         # if nothing changed _updateFromPrevious will return False
@@ -164,6 +199,14 @@ class HashingCondition(ConditionModule):
     _methods = [""]
     method = ""
     limit = 1
+    _maxLimit = 50
+    # the pairs are kept up to this much above the limit, so that moving
+    # the slider within that range does not compare the hashes again
+    _cacheMargin = 5
+    _cacheKey = None
+    _cacheRadius = -1
+    _hashedChecksums = set()
+    _smallestDistances = []
 
     def _makeAdditionalWidgets(self):
         self._Combo = ttk.Combobox(
@@ -180,7 +223,7 @@ class HashingCondition(ConditionModule):
         self._Scale = CS.LabelScale(
             self._options_frame,
             from_=1,
-            to=50,
+            to=self._maxLimit,
             takefocus=1,
             command=self._scaleChanged,
             variable=limitVar,
@@ -202,22 +245,74 @@ class HashingCondition(ConditionModule):
         self._somethingChanged()
 
     def _preMatching(self):
-        # Call this to make sure the hash values for this method are available
-        self._Ctrl.setHashes(hashName=self.method)
-        self._matchingInfo = []
+        # Call this to make sure the hash values for this method are
+        # available, unless they are known to fail
+        cat = self._Ctrl.Catalogue
+        rows = cat.rows(self._checksums)
+        if any(
+                not cat.hasHash(self.method, row) and not cat.hashFailed(self.method, row)
+                for row in rows
+        ):
+            self._Ctrl.setHashes(hashName=self.method)
+        # leave out the files of which the calculation failed or was
+        # cancelled, self._checksums is kept to notice changes
+        self._hashedChecksums = {
+            c for c, row in zip(self._checksums, rows)
+            if cat.hasHash(self.method, row)
+        }
 
     def _postMatching(self):
-        if not self._matchingInfo:
-            self._ScaleTip.text = ""
-        elif len(self._matchingInfo) < 10:
-            self._ScaleTip.text = f"Min: {math.ceil(min(self._matchingInfo))}"
+        smallest = self._smallestDistances
+        if not smallest:
+            # no pair within the radius or not even one pair
+            self._ScaleTip.text = f"Min: >{self._cacheRadius}" if len(self._hashedChecksums) > 1 else ""
+        elif len(smallest) < 10:
+            self._ScaleTip.text = f"Min: {math.ceil(smallest[0])}"
         else:
-            self._matchingInfo.sort()
             self._ScaleTip.text = (
-                f"min={math.ceil(min(self._matchingInfo))}; "
-                f">10 pairs={math.ceil(self._matchingInfo[9])}"
+                f"min={math.ceil(smallest[0])}; "
+                f">10 pairs={math.ceil(smallest[9])}"
             )
 
+    def _distance(self, rowA, rowB):
+        pass
+
+    def _theymatch(self, rowA, rowB):
+        return self._distance(rowA, rowB) <= self.limit
+
+    def _distancePairs(self, rows, radius):
+        """return (distance, rowA, rowB) of the pairs within radius
+        and the smallest distances of all compared pairs"""
+        pairs = []
+        distances = []
+        for rowA, rowB in itertools.combinations(rows, 2):
+            dist = self._distance(rowA, rowB)
+            distances.append(dist)
+            if dist <= radius:
+                pairs.append((dist, rowA, rowB))
+        return pairs, heapq.nsmallest(10, distances)
+
+    def _getMatchingGroups(self):
+        # the pairs sorted by distance are kept for the method and
+        # checksums, when only the limit changes the matches are found
+        # with a binary search
+        cat = self._Ctrl.Catalogue
+        cacheKey = (self.method, frozenset(self._hashedChecksums))
+        if cacheKey != self._cacheKey or self.limit > self._cacheRadius:
+            radius = min(self._maxLimit, self.limit + self._cacheMargin)
+            pairs, smallest = self._distancePairs(cat.rows(self._hashedChecksums), radius)
+            pairs.sort()
+            self._cachedDistances = [dist for dist, dummy, dummy in pairs]
+            self._cachedPairs = [
+                (cat.checksums[rowA], cat.checksums[rowB]) for dummy, rowA, rowB in pairs
+            ]
+            self._smallestDistances = sorted(smallest)[:10]
+            self._cacheKey = cacheKey
+            self._cacheRadius = radius
+
+        nmatches = bisect.bisect_right(self._cachedDistances, self.limit)
+        self._currentMatchingGroups = self._groupsFromPairs(self._cachedPairs[:nmatches])
+
 
 class GradientCondition(HashingCondition):
     name = "gradients"
@@ -226,15 +321,25 @@ class GradientCondition(HashingCondition):
     method = "Horizontal"
     limit = 14
 
-    def _theymatch(self, checksumA, checksumB):
-        hashA = self._Ctrl.FODict[checksumA][0].hashDict[self.method]
-        hashB = self._Ctrl.FODict[checksumB][0].hashDict[self.method]
-        dist = functools.reduce(
-            add,
-            [format(hashA[i] ^ hashB[i], "b").count("1") for i in range(len(hashA))]
-        )
-        self._matchingInfo.append(dist)
-        return dist <= self.limit
+    def _preMatching(self):
+        super()._preMatching()
+        # the 8 bytes of each hash as one 64-bit number
+        cat = self._Ctrl.Catalogue
+        self._packedHashes = {
+            row: int.from_bytes(cat.hash(self.method, row), "little")
+            for row in cat.rows(self._hashedChecksums)
+        }
+
+    def _distance(self, rowA, rowB):
+        # the hamming distance
+        return HF.popcount(self._packedHashes[rowA] ^ self._packedHashes[rowB])
+
+    def _distancePairs(self, rows, radius):
+        "find the pairs within radius with an index instead of comparing all pairs"
+        index = HI.HammingIndex([self._packedHashes[row] for row in rows], radius)
+        pairs = [(dist, rows[idA], rows[idB]) for idA, idB, dist in index.pairs()]
+        # only the distances of the pairs within radius are known
+        return pairs, heapq.nsmallest(10, [dist for dist, dummy, dummy in pairs])
 
 
 class ColorCondition(HashingCondition):
@@ -250,10 +355,12 @@ class ColorCondition(HashingCondition):
     ]
     method = "HSV (5 regions)"
     limit = 10
+    # number of elements in the differences of one tile of pairs
+    _tileElements = 1 << 20
 
-    def _theymatch(self, checksumA, checksumB):
-        hashA = self._Ctrl.FODict[checksumA][0].hashDict[self.method]
-        hashB = self._Ctrl.FODict[checksumB][0].hashDict[self.method]
+    def _distance(self, rowA, rowB):
+        hashA = self._Ctrl.Catalogue.hash(self.method, rowA)
+        hashB = self._Ctrl.Catalogue.hash(self.method, rowB)
         # we need to take care of the median hue value (0, 6, .. th element)
         # when calculating distance because this is a measure that wraps at 255
         # back to 0. The correct distance is the minimum of:
@@ -267,9 +374,57 @@ class ColorCondition(HashingCondition):
             ]
         else:
             distArr = [abs(hashA[i]-hashB[i]) for i in range(len(hashA))]
-        val = sum(distArr)/len(distArr)
-        self._matchingInfo.append(val)
-        return val <= self.limit
+        return sum(distArr)/len(distArr)
+
+    def _distancePairs(self, rows, radius):
+        """the same as comparing each pair with _distance but with numpy:
+        the distances are calculated for tiles of pairs at once"""
+        if len(rows) < 2:
+            return [], []
+        if np is None:
+            return super()._distancePairs(rows, radius)
+
+        values, width = self._Ctrl.Catalogue.hashValues(self.method)
+        hashes = np.frombuffer(values, dtype=np.uint8).reshape(-1, width)
+        hashes = hashes[rows].astype(np.int16)
+        rows = np.asarray(rows)
+        nrows = len(rows)
+        # the columns with the median hue
+        hue = np.zeros(width, dtype=bool)
+        if self.method in ["HSV", "HSV (5 regions)"]:
+            hue[::6] = True
+        maxSum = radius*width
+        tile = max(1, math.isqrt(self._tileElements//width))
+
+        pairs = []
+        smallest = []
+        for startA in range(0, nrows, tile):
+            hashesA = hashes[startA:startA+tile, np.newaxis, :]
+            for startB in range(startA, nrows, tile):
+                hashesB = hashes[np.newaxis, startB:startB+tile, :]
+                dist = np.abs(hashesA - hashesB)
+                # the hue wraps at 255
+                wrapped = dist[:, :, hue] % 255
+                dist[:, :, hue] = np.minimum(wrapped, 255 - wrapped)
+                sums = dist.sum(axis=2)
+
+                valid = np.ones(sums.shape, dtype=bool)
+                if startA == startB:
+                    # each pair once
+                    valid = np.triu(valid, 1)
+                # the smallest distances are enough for the tooltip
+                validSums = sums[valid]
+                if len(validSums) > 10:
+                    validSums = np.partition(validSums, 9)[:10]
+                smallest.extend((validSums/width).tolist())
+
+                idxA, idxB = np.nonzero(valid & (sums <= maxSum))
+                pairs.extend(zip(
+                    (sums[idxA, idxB]/width).tolist(),
+                    rows[idxA + startA].tolist(),
+                    rows[idxB + startB].tolist()
+                ))
+        return pairs, heapq.nsmallest(10, smallest)
 
 
 class ExifCondition(ConditionModule):
@@ -321,15 +476,45 @@ class CameraCondition(ExifCondition):
     _scaleDict = {"Same": True, "Different": False}
     _initialScaleVal = "Same"
 
-    def _theymatch(self, checksumA, checksumB):
-        camA = self._Ctrl.FODict[checksumA][0].cameraModel()
-        camB = self._Ctrl.FODict[checksumB][0].cameraModel()
-        if camA == "":
+    def _theymatch(self, rowA, rowB):
+        # the interned model ids, 0 is a missing model
+        camA = self._Ctrl.Catalogue.models[rowA]
+        camB = self._Ctrl.Catalogue.models[rowB]
+        if camA == 0 and camB == 0:
             return False
-        if self.missingmatches and camB == "":
-            return True
+        if camA == 0 or camB == 0:
+            return self.missingmatches
         return (camA == camB) == self.scalevalue
 
+    def _getMatchingGroups(self):
+        # put the checksums in buckets by camera model instead of
+        # comparing all pairs
+        cat = self._Ctrl.Catalogue
+        buckets = {}
+        for checksum in self._checksums:
+            buckets.setdefault(cat.models[cat.row(checksum)], set()).add(checksum)
+        missing = buckets.pop(0, set()) if self.missingmatches else set()
+        buckets.pop(0, None)
+        present = set().union(*buckets.values())
+
+        groups = {}
+        for bucket in buckets.values():
+            if self.scalevalue:
+                # the checksums of one model share their group
+                group = bucket | missing
+                if len(group) > 1:
+                    groups.update(dict.fromkeys(bucket, group))
+                continue
+            others = (present - bucket) | missing
+            if others:
+                for checksum in bucket:
+                    groups[checksum] = others | {checksum}
+        # a missing model matches all the present models
+        if present:
+            for checksum in missing:
+                groups[checksum] = present | {checksum}
+        self._currentMatchingGroups = groups
+
 
 class DateCondition(ExifCondition):
     name = "closeintime"
@@ -345,14 +530,25 @@ class DateCondition(ExifCondition):
     }
     _initialScaleVal = "10 minutes"
 
-    def _theymatch(self, checksumA, checksumB):
-        dateA = self._Ctrl.FODict[checksumA][0].dateTime
-        dateB = self._Ctrl.FODict[checksumB][0].dateTime
-        if dateA == "Missing":
+    def _theymatch(self, rowA, rowB):
+        dateA = self._Ctrl.Catalogue.timestamps[rowA]
+        dateB = self._Ctrl.Catalogue.timestamps[rowB]
+        if dateA == CAT.MISSINGDATE and dateB == CAT.MISSINGDATE:
             return False
-        if dateB == "Missing":
+        if dateA == CAT.MISSINGDATE or dateB == CAT.MISSINGDATE:
             return self.missingmatches
-        return abs((dateA - dateB).total_seconds()) <= self.scalevalue
+        return abs(dateA - dateB) <= self.scalevalue
+
+    def _matchingPairs(self, rows):
+        "the pictures close in time from a sweep over the sorted dates"
+        timestamps = self._Ctrl.Catalogue.timestamps
+        dated = [row for row in rows if timestamps[row] != CAT.MISSINGDATE]
+        pairs = self._windowPairs(dated, timestamps.__getitem__, self.scalevalue)
+        if self.missingmatches:
+            # a picture without date matches all pictures with a date
+            missing = [row for row in rows if timestamps[row] == CAT.MISSINGDATE]
+            pairs.extend(itertools.product(missing, dated))
+        return pairs
 
 
 class ShapeCondition(ExifCondition):
@@ -371,13 +567,39 @@ class ShapeCondition(ExifCondition):
     _initialScaleVal = "Portrait/Landscape"
     _showMissingMatches = False
 
-    def _theymatch(self, checksumA, checksumB):
+    def _shapeParameter(self, row):
+        w = self._Ctrl.Catalogue.widths[row]
+        h = self._Ctrl.Catalogue.heights[row]
+        # (width-height)/(width+height)*100
+        # positive for landscape, negative for portait
+        return (w-h)/(w+h)*100
+
+    def _theymatch(self, rowA, rowB):
+        cat = self._Ctrl.Catalogue
         if self.scalevalue == -2:
-            sizeA = self._Ctrl.FODict[checksumA][0].size
-            sizeB = self._Ctrl.FODict[checksumB][0].size
+            sizeA = (cat.widths[rowA], cat.heights[rowA])
+            sizeB = (cat.widths[rowB], cat.heights[rowB])
             return set(sizeA) != set(sizeB)
-        shapeA = self._Ctrl.FODict[checksumA][0].shapeParameter()
-        shapeB = self._Ctrl.FODict[checksumB][0].shapeParameter()
+        shapeA = self._shapeParameter(rowA)
+        shapeB = self._shapeParameter(rowB)
         if self.scalevalue == -1:
             return shapeA*shapeB > 0.0 or (shapeA == shapeB == 0.0)
         return abs(shapeA - shapeB) <= self.scalevalue
+
+    def _matchingPairs(self, rows):
+        "the pictures with a similar shape without comparing all pairs"
+        if self.scalevalue == -2:
+            # nearly all pairs have a different size
+            return super()._matchingPairs(rows)
+
+        shapes = {row: self._shapeParameter(row) for row in rows}
+        if self.scalevalue == -1:
+            # all pairs within landscape, portrait and square
+            orientations = {}
+            for row, shape in shapes.items():
+                orientations.setdefault((shape > 0) - (shape < 0), []).append(row)
+            return [
+                pair for group in orientations.values()
+                for pair in itertools.combinations(group, 2)
+            ]
+        return self._windowPairs(rows, shapes.__getitem__, self.scalevalue)
@@ -2,6 +2,7 @@
 import sys
 import os.path
 import configparser
+import hashlib
 
 
 def str2bool(S):
@@ -64,6 +65,11 @@ class Configuration():
         self.set("viewergeometry", "1200x800+50+0")
         self.set("restoremovefolders", False)
         self.set("smartzoomtofit", False)
+        self.set("checksumalgorithm", "sha1")
+        self.set("checksumimagedataonly", False)
+        self.set("workerprocesses", 0)
+        self.set("thumbnailcachesize", 256)
+        self.set("reduceddecoding", True)
         for i in range(1, self.get("numfolders")+1):
             self.set("folder"+str(i), "")
 
@@ -85,6 +91,18 @@ class Configuration():
             viewerGeometry = default.get("viewergeometry", "1200x800+50+0")
             restoremovefolders = default.getstrbool("restoremovefolders", "no")
             smartzoomtofit = default.getstrbool("smartzoomtofit", "no")
+            checksumAlgorithm = default.get("checksumalgorithm", "sha1")
+            # only fixed length hashlib algorithms can identify files
+            if (
+                    checksumAlgorithm not in hashlib.algorithms_guaranteed or
+                    checksumAlgorithm.startswith("shake")
+            ):
+                checksumAlgorithm = "sha1"
+            checksumImageDataOnly = default.getstrbool("checksumimagedataonly", "no")
+            workerProcesses = max(0, default.getint("workerprocesses", 0))
+            # MB of thumbnails kept in the DataBase, 0 disables the cache
+            thumbnailCacheSize = max(0, default.getint("thumbnailcachesize", 256))
+            reducedDecoding = default.getstrbool("reduceddecoding", "yes")
             # store read values in ConfigurationDict
             self.set("searchinsubfolders", doRecursive)
             self.set("confirmdelete", confirmdelete)
@@ -99,6 +117,11 @@ class Configuration():
             self.set("viewergeometry", viewerGeometry)
             self.set("restoremovefolders", restoremovefolders)
             self.set("smartzoomtofit", smartzoomtofit)
+            self.set("checksumalgorithm", checksumAlgorithm)
+            self.set("checksumimagedataonly", checksumImageDataOnly)
+            self.set("workerprocesses", workerProcesses)
+            self.set("thumbnailcachesize", thumbnailCacheSize)
+            self.set("reduceddecoding", reducedDecoding)
 
             # restore move folders enabled
             if restoremovefolders:
@@ -133,6 +156,11 @@ class Configuration():
             "viewergeometry": self.get("viewergeometry"),
             "restoremovefolders": self.get("restoremovefolders"),
             "smartzoomtofit": self.get("smartzoomtofit"),
+            "checksumalgorithm": self.get("checksumalgorithm"),
+            "checksumimagedataonly": self.get("checksumimagedataonly"),
+            "workerprocesses": self.get("workerprocesses"),
+            "thumbnailcachesize": self.get("thumbnailcachesize"),
+            "reduceddecoding": self.get("reduceddecoding"),
         }
         for i in range(1, self.get("numfolders")+1):
             config["simimg"].update({"folder"+str(i): self.get("folder"+str(i))})
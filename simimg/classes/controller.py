@@ -5,12 +5,16 @@ the fileinfo objects and the display of the thumbnails.
 import glob
 import os
 import sys
+import time
+import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog as tkfiledialog
 
 from PIL import ImageTk
 
+import simimg.classes.catalogue as CAT
 import simimg.classes.conditionmodules as CM
+import simimg.classes.databasewriter as DW
 import simimg.classes.fileobject as FO
 import simimg.classes.imageframe as IF
 import simimg.classes.miscmodules as MM
@@ -52,6 +56,22 @@ def tellstatus(msg):
     return decorator_tellstatus
 
 
+# decorator for methods that run a job in the worker pool: the progress is
+# shown in the status bar and the job can be cancelled by pressing Escape
+def pooljob(msg):
+    def decorator_pooljob(f):
+        def wrapper_pooljob(self, *args, **kwargs):
+            self._startPoolJob(msg)
+            try:
+                f(self, *args, **kwargs)
+                # the next job reads what this one stored
+                self._DBWriter.flush()
+            finally:
+                self._stopPoolJob()
+        return wrapper_pooljob
+    return decorator_pooljob
+
+
 class Controller():
     "Controller object that initializes the program and reacts to events."
 
@@ -65,7 +85,10 @@ class Controller():
 
         # empty starting values
         self.FODict = {}
+        self.Catalogue = CAT.Catalogue()
         self._DBConnection = None
+        self._DBWriter = None
+        self._Pool = None
         self._fileList = []
         self._filenameCommon = ""
         self._filenameUniqueDict = {}
@@ -75,6 +98,13 @@ class Controller():
         self._filenameChecksumDict = {}
         self.busyCursorCount = 0
         self._someConditionActive = False
+        self._poolJobRunning = False
+        self._viewRebuildPending = False
+        self._poolJobMsg = ""
+        self._poolJobStart = 0.0
+        self._poolJobShown = 0.0
+        self._poolJobFocus = None
+        self._cancelRequested = False
 
         # call the exitProgram function when the user clicks the X
         self.TopWindow.protocol("WM_DELETE_WINDOW", self.exitProgram)
@@ -143,6 +173,7 @@ Right click on the folders below to set or change its path"""
         self._MovePanel = MM.MovePanel(self.TopWindow.ModulePane, Controller=self)
         self._MovePanel.pack(side="top", fill="x")
 
+        self.startPool()
         self.startDatabase()
         self._getFileList()
         self._processFilelist()
@@ -155,10 +186,24 @@ Right click on the folders below to set or change its path"""
         # check of the number of thumb columns will change
         if oldTPWidth // thumbW == self._TPWidth // thumbW:
             return
+        self._rebuildView()
+
+    def _rebuildView(self):
+        """ Show the thumbnails again for the new width of the window.
+        While a pool job runs this waits until it is done, the
+        thumbnails can be missing and would be made on the spot"""
+        if self._poolJobRunning:
+            self._viewRebuildPending = True
+            return
         if not self._someConditionActive:
             self._createViewWithoutConditions()
 
     def _onKeyPress(self, event):
+        # while a pool job runs only cancelling it is possible
+        if self._poolJobRunning:
+            if event.keysym == "Escape":
+                self._cancelRequested = True
+            return
         if event.keysym == "F1":
             IW.showInfoDialog()
             return
@@ -216,10 +261,26 @@ Right click on the folders below to set or change its path"""
         if not DB.createTables(self._DBConnection, clear=clear):
             sys.exit(1)
 
+        # the pool jobs store their results in the background
+        self._DBWriter = DW.DatabaseWriter(self.Cfg.get("databasename"))
+
     def stopDatabase(self):
+        self._DBWriter.close()
         DB.closeConnection(self._DBConnection)
 
+    def startPool(self):
+        self._Pool = POOL.createPool(self.Cfg.get("workerprocesses"))
+
+    def stopPool(self):
+        POOL.closePool(self._Pool)
+
     def exitProgram(self):
+        # first let a running pool job stop
+        if self._poolJobRunning:
+            self._cancelRequested = True
+            self.TopWindow.after(100, self.exitProgram)
+            return
+        self.stopPool()
         self.stopDatabase()
         self.Cfg.set("findergeometry", self.TopWindow.geometry())
         # make a dictionary of cm.name: is_folded
@@ -261,6 +322,7 @@ Right click on the folders below to set or change its path"""
             pathList = [Replace]
             oldFiles = []
             self.FODict = {}
+            self.Catalogue = CAT.Catalogue()
         # from add folder
         if Add:
             pathList = [Add]
@@ -320,9 +382,10 @@ Right click on the folders below to set or change its path"""
         if not self.FODict:
             self.showInStatusbar("Warning: no files containing image data found")
 
-        # calculate thumbnails in multiprocessing
+        # calculate thumbnails and hashes in multiprocessing
         self._setThumbnails()
 
+    @pooljob(msg="Reading the image information")
     def _createFileobjects(self):
         # Make list of image file objects with all files PIL can read
         fileObjectList = []
@@ -331,17 +394,28 @@ Right click on the folders below to set or change its path"""
         for fol in self.FODict.values():
             existingfiles.extend([fo.fullPath for fo in fol])
 
-        missingfilelist = list(set(self._fileList) - set(existingfiles))
-        for FilePath in missingfilelist:
-            ThisFileObject = FO.FileObject(
-                self,
-                FullPath=FilePath,
-                checksumFilenameDict=self._checksumFilenameDict
+        # files without checksum (cancelled) are left out
+        missingfilelist = [
+            f for f in set(self._fileList) - set(existingfiles)
+            if f in self._checksumFilenameDict
+        ]
+        # find the image files and their properties in the pool
+        probeDict = POOL.getProbes(
+            missingfilelist,
+            self._checksumFilenameDict,
+            algorithm=self._checksumAlgorithmName(),
+            db_connection=self._DBConnection,
+            db_writer=self._DBWriter,
+            pool=self._Pool,
+            progress=self._reportProgress
+        )
+        for FilePath, probe in probeDict.items():
+            fileId = self.Catalogue.addFile(
+                FilePath,
+                self._checksumFilenameDict[FilePath],
+                probe
             )
-            if ThisFileObject.isImage:
-                fileObjectList.append(ThisFileObject)
-                # do checksum hash and thumbnails
-                ThisFileObject.checksum()
+            fileObjectList.append(FO.FileObject(self.Catalogue, fileId))
 
         if not fileObjectList:
             return
@@ -625,22 +699,100 @@ Right click on the folders below to set or change its path"""
             ):
                 tp.select(True)
 
+    def _checksumAlgorithmName(self):
+        "The name under which the checksums are known in the database"
+        return POOL.checksumAlgorithmName(
+            self.Cfg.get("checksumalgorithm"),
+            imageDataOnly=self.Cfg.get("checksumimagedataonly")
+        )
+
     # some routines related to expensive calculations done in a
     # multiprocessing pool
-    @tellstatus(msg="Calculating File Hash values, please be patient")
+    def _startPoolJob(self, msg):
+        self._poolJobRunning = True
+        self._poolJobMsg = msg
+        self._poolJobStart = time.monotonic()
+        self._poolJobShown = 0.0
+        self._cancelRequested = False
+        self.showInStatusbar(msg)
+        # keep the user from changing things while the job runs: only the
+        # status bar gets the mouse and keyboard events
+        self._poolJobFocus = self.TopWindow.focus_get()
+        try:
+            self.TopWindow.Statusbar.grab_set()
+            self.TopWindow.Statusbar.focus_set()
+        except tk.TclError:
+            pass
+
+    def _stopPoolJob(self):
+        self.TopWindow.Statusbar.grab_release()
+        try:
+            if self._poolJobFocus:
+                self._poolJobFocus.focus_set()
+        except tk.TclError:
+            pass
+        self._poolJobRunning = False
+        if self._viewRebuildPending:
+            self._viewRebuildPending = False
+            self.TopWindow.after_idle(self._rebuildView)
+        if self._cancelRequested:
+            # throw away the tasks that are still queued in the pool
+            POOL.terminatePool(self._Pool)
+            self.startPool()
+            self.showInStatusbar(f"{self._poolJobMsg}: cancelled")
+            return
+        self.showInStatusbar("...")
+
+    def _reportProgress(self, done, total):
+        """ Show the progress of a pool job and return whether the
+        user asked to cancel it"""
+        now = time.monotonic()
+        if done == 0:
+            self._poolJobStart = now
+        # no need to refresh the status bar for every file
+        if 0 < done < total and now - self._poolJobShown < 0.2:
+            return self._cancelRequested
+        self._poolJobShown = now
+        rate = done/max(now - self._poolJobStart, 1e-6)
+        eta = f"{(total - done)/rate:.0f}s" if rate else "?"
+        self.showInStatusbar(
+            f"{self._poolJobMsg}: {done} of {total}, {rate:.1f} files/s, "
+            f"ETA {eta} (press Escape to cancel)"
+        )
+        # handle the Escape key
+        self.TopWindow.update()
+        return self._cancelRequested
+
+    @pooljob(msg="Calculating File Hash values")
     def _getChecksums(self):
-        self._checksumFilenameDict = POOL.getChecksums(self._fileList, self._checksumFilenameDict)
+        self._checksumFilenameDict = POOL.getChecksums(
+            self._fileList,
+            self._checksumFilenameDict,
+            algorithm=self.Cfg.get("checksumalgorithm"),
+            imageDataOnly=self.Cfg.get("checksumimagedataonly"),
+            db_connection=self._DBConnection,
+            db_writer=self._DBWriter,
+            pool=self._Pool,
+            progress=self._reportProgress
+        )
         self._filenameChecksumDict = dict(map(reversed, self._checksumFilenameDict.items()))
 
-    @tellstatus(msg="Making file thumbnails, please be patient")
+    @pooljob(msg="Making file thumbnails and image hashes")
     def _setThumbnails(self):
-        checksumThumbDict = POOL.getThumbnails(
+        checksumThumbDict = POOL.indexImages(
+            self.Catalogue,
             self.FODict,
             Thumbsize=self.Cfg.get("thumbnailsize"),
             channel=self.Cfg.get("channeltoshow"),
             upscale=self.Cfg.get("upscalethumbnails"),
+            reduced=self.Cfg.get("reduceddecoding"),
+            algorithm=self._checksumAlgorithmName(),
+            cacheSize=self.Cfg.get("thumbnailcachesize")*2**20,
+            db_connection=self._DBConnection,
+            db_writer=self._DBWriter,
+            pool=self._Pool,
+            progress=self._reportProgress
         )
-        self.showInStatusbar("...")
         if not checksumThumbDict:
             return
         for checksum, thumb in checksumThumbDict.items():
@@ -654,11 +806,19 @@ Right click on the folders below to set or change its path"""
                 del self.FODict[checksum]
                 continue
 
-            fo = self.FODict[checksum]
-            for afo in fo:
-                afo._thumbnail = pimage
+            self.Catalogue.thumbnails[self.Catalogue.row(checksum)] = pimage
 
     @longrunning
-    @tellstatus(msg="Calculating Image Hash values, please be patient")
+    @pooljob(msg="Calculating Image Hash values")
     def setHashes(self, hashName=None):
-        POOL.getHashes(self.FODict, hashName, self._DBConnection)
+        POOL.getHashes(
+            self.Catalogue,
+            self.FODict,
+            hashName,
+            algorithm=self._checksumAlgorithmName(),
+            reduced=self.Cfg.get("reduceddecoding"),
+            db_connection=self._DBConnection,
+            db_writer=self._DBWriter,
+            pool=self._Pool,
+            progress=self._reportProgress
+        )
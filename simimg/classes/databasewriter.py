@@ -0,0 +1,82 @@
+""" Background writer for the DataBase.
+
+The writes of a process go through one thread with its own connection.
+The pool jobs queue their batches and continue, the thread commits them
+(several queued batches together in one transaction) and waits for the
+lock when another process that uses the same DataBase is writing.
+"""
+import queue
+import threading
+
+import simimg.utils.database as DB
+
+
+class DatabaseWriter():
+    " Thread that stores the queued batches of DataBase writes "
+
+    # at most this many queued batches are committed together
+    _maxMerge = 16
+
+    def __init__(self, db_file):
+        self._dbFile = db_file
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._run,
+            name="DatabaseWriter",
+            daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, writes):
+        """queue a list of (function, args, kwargs) writes with the set
+        functions of the database module, to be stored in one transaction"""
+        if writes:
+            self._queue.put(writes)
+
+    def flush(self):
+        """wait until all queued writes are stored, raise the error of
+        a write that failed since the last flush"""
+        self._queue.join()
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def close(self):
+        "store the queued writes and stop the thread"
+        self._queue.put(None)
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        db_connection = DB.createConnection(self._dbFile)
+        stopping = False
+        while not stopping:
+            writes = self._queue.get()
+            merged = []
+            taken = 1
+            while writes is not None:
+                merged.extend(writes)
+                if taken >= self._maxMerge:
+                    break
+                try:
+                    writes = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                taken += 1
+            stopping = writes is None
+
+            if merged:
+                try:
+                    if db_connection is None:
+                        raise OSError(f"Cannot open the DataBase {self._dbFile}")
+                    DB.writeBatch(merged, db_connection)
+                except Exception as error:
+                    # keep the first one for flush
+                    if self._error is None:
+                        self._error = error
+            for _ in range(taken):
+                self._queue.task_done()
+
+        if db_connection is not None:
+            db_connection.close()
@@ -1,129 +1,58 @@
 """ The basic object that represents one file """
-from functools import cached_property
-import hashlib
 import os
-from datetime import datetime
-
-from PIL import Image, ExifTags
 
 import simimg.utils.pillowplus as PP
 
 
 class FileObject():
-    " File object that contains all information relating to one file on disk "
+    """ File object that gives access to all information relating to one
+    file on disk. The information itself is kept in the Catalogue. """
 
-    def __init__(self, parent, FullPath=None, checksumFilenameDict=None):
-        self._Ctrl = parent
-        self._Cfg = parent.Cfg
-        self.fullPath = FullPath
-        self.dirName = os.path.dirname(self.fullPath)
-        self.fileName = os.path.basename(self.fullPath)
-        dummy, self.fileExtension = os.path.splitext(self.fileName)
+    __slots__ = ("_Cat", "fileId")
 
-        self.hashDict = {}
+    def __init__(self, Catalogue, fileId):
+        self._Cat = Catalogue
+        self.fileId = fileId
 
-        self._checksum = (
-            checksumFilenameDict[FullPath]
-            if FullPath in checksumFilenameDict
-            else None
-        )
-        self._size = None
-        self._thumbnail = None
-        # It this file active
-        self.active = True
+    @property
+    def row(self):
+        " the row of the checksum of this file in the catalogue "
+        return self._Cat.fileRows[self.fileId]
 
-    @cached_property
-    def isImage(self):
-        " Set IsImage to True if the file can be read by PIL "
-        try:
-            img = Image.open(self.fullPath)
-            # do this here to save time
-            self._size = img.size
-            return True
-        except:
-            return False
+    @property
+    def fullPath(self):
+        return self._Cat.filePath(self.fileId)
 
-    def checksum(self):
-        if self._checksum is None:
-            hasher = hashlib.sha1()
-            with open(self.fullPath, "rb") as afile:
-                hasher.update(afile.read())
-                self._checksum = hasher.hexdigest()
-        return self._checksum
+    @property
+    def dirName(self):
+        return self._Cat.dirNames[self._Cat.fileDirs[self.fileId]]
 
-    @cached_property
-    def exifTags(self):
-        # default to empty basic values
-        exifTags = {
-            "Make": "",
-            "Model": "",
-            "DateTimeOriginal": "",
-            "DateTime": "",
-            "DateTimeDigitized": ""
-        }
-        with Image.open(self.fullPath) as image:
-            # image does not have method to get tags
-            if not hasattr(image, "_getexif"):
-                return exifTags
-            exif = image._getexif()
-            # image does not have tags
-            if not exif:
-                return exifTags
-            for key, value in exif.items():
-                if key in ExifTags.TAGS:
-                    exifTags[ExifTags.TAGS[key]] = value
-            return exifTags
+    @property
+    def fileName(self):
+        return self._Cat.fileNames[self.fileId]
 
-    def cameraMake(self):
-        return self.exifTags["Make"]
+    @property
+    def fileExtension(self):
+        return os.path.splitext(self.fileName)[1]
 
-    def cameraModel(self):
-        return self.exifTags["Model"]
+    @property
+    def active(self):
+        " It this file active "
+        return self._Cat.fileActive[self.fileId] == 1
 
-    def date(self):
-        if self.exifTags["DateTimeOriginal"]:
-            return self.exifTags["DateTimeOriginal"]
-        if self.exifTags["DateTime"]:
-            return self.exifTags["DateTime"]
-        if self.exifTags["DateTimeDigitized"]:
-            return self.exifTags["DateTimeDigitized"]
-        return ""
+    @active.setter
+    def active(self, value):
+        self._Cat.fileActive[self.fileId] = 1 if value else 0
 
-    @cached_property
-    def dateTime(self):
-        thisDateString = self.date()
-        if thisDateString == "":
-            return "Missing"
-        try:
-            dateTime = datetime.strptime(
-                thisDateString,
-                "%Y:%m:%d %H:%M:%S"
+    def checksum(self):
+        return self._Cat.checksums[self.row]
+
+    def thumbnail(self, ThumbSize):
+        row = self.row
+        if self._Cat.thumbnails[row] is None:
+            self._Cat.thumbnails[row] = PP.photoImageOpenAndResizeToFit(
+                self.fullPath,
+                ThumbSize,
+                ThumbSize
             )
-        except:
-            return "Missing"
-        return dateTime
-
-    @cached_property
-    def size(self):
-        if self._size is not None:
-            return self._size
-        my_size = (0, 0)
-        with Image.open(self.fullPath) as image:
-            my_size = image.size
-        return my_size
-
-    def shapeParameter(self):
-        w, h = self.size
-        # (width-height)/(width+height)*100
-        # positive for landscape, negative for portait
-        return (w-h)/(w+h)*100
-
-    def thumbnail(self):
-        if self._thumbnail is None:
-            ThumbSize = self._Cfg.get("thumbnailsize")
-            self._thumbnail = PP.photoImageOpenAndResizeToFit(
-               self.fullPath,
-               ThumbSize,
-               ThumbSize
-           )
-        return self._thumbnail
+        return self._Cat.thumbnails[row]
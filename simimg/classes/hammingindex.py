@@ -0,0 +1,140 @@
+""" Index to find the hashes within a Hamming distance (number of
+different bits) of each other without comparing every pair.
+
+Multi-index hashing: the bits are split in chunks and each chunk gets a
+table of the hashes by the value of that chunk. If two hashes differ in
+at most radius bits, at least one of their chunks differs in at most
+radius//number of chunks bits (pigeonhole). So only the hashes in the
+table entries near the chunks of the query need to be compared.
+"""
+import itertools
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import simimg.utils.handyfunctions as HF
+
+
+def bitFlips(nbits, maxFlips):
+    "all masks of nbits with at most maxFlips bits set"
+    masks = []
+    for nflips in range(maxFlips+1):
+        for bits in itertools.combinations(range(nbits), nflips):
+            masks.append(sum(1 << b for b in bits))
+    return masks
+
+
+def popcounts(values):
+    "number of 1 bits of each element of an uint64 numpy array"
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+class HammingIndex():
+    " Multi-index hashing of non-negative ints of at most nbits bits "
+
+    # time of one table lookup relative to comparing one candidate
+    _lookupCost = 100 if np else 8
+
+    def __init__(self, hashes, radius, nbits=64):
+        """ index the hashes (ids are the positions in the list) for
+        queries up to radius """
+        self.hashes = list(hashes)
+        self.radius = radius
+        self.nbits = nbits
+        self._nchunks = self._bestNumberOfChunks()
+        self._subRadius = radius // self._nchunks
+
+        # (shift, mask, flips) of each chunk
+        self._chunks = []
+        start = 0
+        for chunk in range(self._nchunks):
+            chunkBits = (nbits - start) // (self._nchunks - chunk)
+            self._chunks.append(
+                (start, (1 << chunkBits) - 1, bitFlips(chunkBits, self._subRadius))
+            )
+            start += chunkBits
+
+        # for each chunk a table of chunk value: ids
+        self._tables = []
+        for shift, mask, dummy in self._chunks:
+            table = {}
+            for hashId, value in enumerate(self.hashes):
+                table.setdefault((value >> shift) & mask, []).append(hashId)
+            self._tables.append(table)
+
+        # with numpy the candidates are compared all at once
+        self._hashArray = None
+        if np is not None:
+            self._hashArray = np.array(self.hashes, dtype=np.uint64)
+            for table in self._tables:
+                for chunk, ids in table.items():
+                    table[chunk] = np.array(ids, dtype=np.intp)
+
+    def _bestNumberOfChunks(self):
+        """ the number of chunks for which the table lookups plus the
+        expected number of compared hashes take the least time """
+        nhashes = max(1, len(self.hashes))
+        best = None
+        for nchunks in range(1, min(self.nbits, self.radius+1)+1):
+            chunkBits = self.nbits // nchunks
+            if chunkBits > 24:
+                # too many lookups per query
+                continue
+            flips = sum(math.comb(chunkBits, k) for k in range(self.radius//nchunks + 1))
+            lookups = nchunks*flips
+            cost = lookups*(self._lookupCost + nhashes/2**chunkBits)
+            if best is None or cost < best[0]:
+                best = (cost, nchunks)
+        return best[1] if best else min(self.nbits, self.radius+1)
+
+    def _buckets(self, value):
+        " the table entries with (nearly) the same chunks as value "
+        buckets = []
+        for (shift, mask, flips), table in zip(self._chunks, self._tables):
+            chunk = (value >> shift) & mask
+            for flip in flips:
+                bucket = table.get(chunk ^ flip)
+                if bucket is not None:
+                    buckets.append(bucket)
+        return buckets
+
+    def query(self, value, radius=None):
+        """ return (id, distance) of all indexed hashes within radius
+        (at most the radius of the index) of value """
+        radius = self.radius if radius is None else min(radius, self.radius)
+        buckets = self._buckets(value)
+        if not buckets:
+            return []
+
+        if self._hashArray is None:
+            result = []
+            for hashId in set().union(*buckets):
+                dist = HF.popcount(value ^ self.hashes[hashId])
+                if dist <= radius:
+                    result.append((hashId, dist))
+            return result
+
+        # a hash can be in several buckets, only remove the doubles
+        # of the few that are close enough
+        ids = np.concatenate(buckets)
+        dists = popcounts(self._hashArray[ids] ^ np.uint64(value))
+        ids, first = np.unique(ids[dists <= radius], return_index=True)
+        dists = dists[dists <= radius][first]
+        return list(zip(ids.tolist(), dists.tolist()))
+
+    def pairs(self, radius=None):
+        """ return (idA, idB, distance) with idA < idB of all pairs of
+        indexed hashes within radius """
+        result = []
+        for idA, value in enumerate(self.hashes):
+            result.extend(
+                (idA, idB, dist)
+                for idB, dist in self.query(value, radius=radius)
+                if idB > idA
+            )
+        return result
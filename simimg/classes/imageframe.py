@@ -60,7 +60,7 @@ class ImageFrame(ttk.Frame):
                 self._tSize/2,
                 self._tSize/2,
                 anchor="center",
-                image=self._Ctrl.FODict[self.checksum][0].thumbnail()
+                image=self._Ctrl.FODict[self.checksum][0].thumbnail(self._tSize)
             )
             self._text = self._thumbCanvas.create_text(
                 self._tSize/2,
@@ -1,7 +1,6 @@
 import os
 import sqlite3
-
-import simimg.utils.handyfunctions as HF
+import time
 
 
 def createConnection(db_file):
@@ -15,80 +14,563 @@ def createConnection(db_file):
             return None
 
     try:
-        db_connection = sqlite3.connect(db_file)
-        return db_connection
+        db_connection = sqlite3.connect(db_file, timeout=busyTimeout)
     except sqlite3.Error:
         return None
+    configureConnection(db_connection)
+    return db_connection
+
+
+# several SimImg processes can use one DataBase: a connection waits
+# this many seconds for the lock of another one before it gives up,
+# a batch of writes that still finds the DataBase busy is retried
+busyTimeout = 30.0
+busyRetries = 5
+
+
+# WAL journaling: readers do not block the writer, and with
+# synchronous=NORMAL a commit does not wait for the disk (a crash can
+# lose the last commits, never corrupt the DataBase, it is only a cache)
+connectionPragmas = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    # negative: in kiB, so 64 MB of page cache
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+)
+
+# the DataBase is vacuumed when more than this fraction of its pages
+# is unused, for example after many thumbnails were evicted
+vacuumFreeRatio = 0.25
+
+
+def configureConnection(db_connection):
+    "Set the journaling and cache pragmas of a new connection"
+    for pragma in connectionPragmas:
+        try:
+            db_connection.execute(pragma)
+        except sqlite3.Error:
+            # for example WAL on a file system without shared memory
+            continue
+
+
+def freePageRatio(db_connection):
+    "return the fraction of the pages of the DataBase that are unused"
+    pageCount = db_connection.execute("PRAGMA page_count").fetchone()[0]
+    freeCount = db_connection.execute("PRAGMA freelist_count").fetchone()[0]
+    return freeCount/pageCount if pageCount else 0.0
+
+
+def maintainDatabase(db_connection, maxFreeRatio=vacuumFreeRatio):
+    """let sqlite update its statistics and VACUUM the DataBase, but
+    only if more than maxFreeRatio of its pages are unused.
+    Returns whether it was vacuumed."""
+    db_connection.commit()
+    db_connection.execute("PRAGMA optimize")
+    if freePageRatio(db_connection) <= maxFreeRatio:
+        return False
+    # do not wait for other processes, try again next time
+    db_connection.execute("PRAGMA busy_timeout=0")
+    try:
+        db_connection.execute("VACUUM")
+    except sqlite3.OperationalError as error:
+        if not isBusy(error):
+            raise
+        return False
+    finally:
+        db_connection.execute(f"PRAGMA busy_timeout={int(busyTimeout*1000)}")
+    return True
+
+
+def isBusy(error):
+    "return whether error means that another connection holds the lock"
+    return isinstance(error, sqlite3.OperationalError) and (
+        "locked" in str(error) or "busy" in str(error)
+    )
+
+
+def writeBatch(writes, db_connection=None, retries=busyRetries):
+    """store a list of (function, args, kwargs) writes with the set
+    functions below in one transaction. If one of them fails nothing
+    is stored. If another process keeps the DataBase locked the whole
+    transaction is tried again."""
+    for attempt in range(retries + 1):
+        try:
+            for func, args, kwargs in writes:
+                func(*args, db_connection=db_connection, commit=False, **kwargs)
+            db_connection.commit()
+            return
+        except BaseException as error:
+            db_connection.rollback()
+            if not isBusy(error) or attempt == retries:
+                raise
+        time.sleep(0.1*2**attempt)
+
+
+# version of the layout of the tables, stored in the user_version
+# of the DataBase and used to upgrade older DataBases in place
+schemaVersion = 1
+
+
+def tableColumns(db_cursor, table):
+    "return the column names of a table (empty if it does not exist)"
+    db_cursor.execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in db_cursor.fetchall()]
+
+
+def migrateTables(db_cursor):
+    "Upgrade the tables of an older DataBase to the current schemaVersion"
+
+    db_cursor.execute("PRAGMA user_version")
+    version = db_cursor.fetchone()[0]
+
+    if version < 1:
+        # the hash table of the first DataBases: without the algorithm
+        # of the file hash (they are all sha1) and with the hash values
+        # as hex strings instead of bytes. The doubles in it are removed
+        # by createTables before the unique index is made
+        columns = tableColumns(db_cursor, "HashValueTable")
+        if columns and "FileHashAlgorithm" not in columns:
+            db_cursor.connection.create_function(
+                "hex2blob", 1, bytes.fromhex, deterministic=True
+            )
+            db_cursor.execute(
+                "CREATE TABLE HashValueTableV1 "
+                "("
+                "id integer PRIMARY KEY,"
+                "FileHash text NOT NULL,"
+                "HashMethod text NOT NULL,"
+                "ImageHashValue blob NOT NULL,"
+                "FileHashAlgorithm text NOT NULL DEFAULT 'sha1'"
+                ")"
+            )
+            db_cursor.execute(
+                "INSERT INTO HashValueTableV1 "
+                "SELECT id, FileHash, HashMethod, hex2blob(ImageHashValue), 'sha1' "
+                "FROM HashValueTable"
+            )
+            db_cursor.execute("DROP TABLE HashValueTable")
+            db_cursor.execute("ALTER TABLE HashValueTableV1 RENAME TO HashValueTable")
+
+    db_cursor.execute(f"PRAGMA user_version = {schemaVersion}")
+
+
+def hasIndex(db_cursor, index):
+    "return whether the index exists"
+    db_cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='index' AND name=?", (index,)
+    )
+    return db_cursor.fetchone() is not None
+
+
+def compactHashTable(db_connection, commit=True):
+    """remove the doubles (same file hash, method and algorithm) from
+    the hash table, keeping the oldest row. Returns the number of
+    removed rows."""
+
+    db_cursor = db_connection.cursor()
+    db_cursor.execute(
+        "DELETE FROM HashValueTable WHERE id NOT IN "
+        "(SELECT MIN(id) FROM HashValueTable "
+        "GROUP BY FileHash, HashMethod, FileHashAlgorithm)"
+    )
+    removed = db_cursor.rowcount
+    db_cursor.close()
+    if commit:
+        db_connection.commit()
+    return removed
 
 
 def createTables(db_connection, clear=None):
-    "Create or empty the required tables in the DataBase"
+    """Create or empty the required tables in the DataBase.
+    The tables are emptied instead of removed, other processes can be
+    using them."""
 
-    sql_delete_table = " DROP TABLE IF EXISTS HashValueTable "
+    sql_delete_table = " DELETE FROM HashValueTable "
     sql_create_table = (
         "CREATE TABLE IF NOT EXISTS HashValueTable "
         "("
         "id integer PRIMARY KEY,"
         "FileHash text NOT NULL,"
         "HashMethod text NOT NULL,"
-        "ImageHashValue text NOT NULL"
+        "ImageHashValue blob NOT NULL,"
+        "FileHashAlgorithm text NOT NULL DEFAULT 'sha1'"
+        ")"
+    )
+    sql_create_index = (
+        "CREATE UNIQUE INDEX IF NOT EXISTS HashValueIndex "
+        "ON HashValueTable (FileHash, HashMethod, FileHashAlgorithm)"
+    )
+    sql_delete_stat_table = " DELETE FROM FileStatTable "
+    sql_create_stat_table = (
+        "CREATE TABLE IF NOT EXISTS FileStatTable "
+        "("
+        "FilePath text NOT NULL,"
+        "FileHashAlgorithm text NOT NULL,"
+        "FileSize integer NOT NULL,"
+        "FileMtime integer NOT NULL,"
+        "FileInode integer NOT NULL,"
+        "FileHash text NOT NULL,"
+        "PRIMARY KEY (FilePath, FileHashAlgorithm)"
+        ")"
+    )
+    sql_delete_metadata_table = " DELETE FROM FileMetadataTable "
+    sql_create_metadata_table = (
+        "CREATE TABLE IF NOT EXISTS FileMetadataTable "
+        "("
+        "FileHash text NOT NULL,"
+        "FileHashAlgorithm text NOT NULL,"
+        "Width integer,"
+        "Height integer,"
+        "Make text NOT NULL,"
+        "Model text NOT NULL,"
+        "DateTime integer,"
+        "PRIMARY KEY (FileHash, FileHashAlgorithm)"
+        ")"
+    )
+    sql_delete_thumbnail_table = " DELETE FROM ThumbnailTable "
+    sql_create_thumbnail_table = (
+        "CREATE TABLE IF NOT EXISTS ThumbnailTable "
+        "("
+        "FileHash text NOT NULL,"
+        "FileHashAlgorithm text NOT NULL,"
+        "ThumbSize integer NOT NULL,"
+        "Channel text NOT NULL,"
+        "Upscale integer NOT NULL,"
+        "Thumbnail blob NOT NULL,"
+        "LastUsed integer NOT NULL,"
+        "PRIMARY KEY (FileHash, FileHashAlgorithm, ThumbSize, Channel, Upscale)"
         ")"
     )
+    sql_create_thumbnail_index = (
+        "CREATE INDEX IF NOT EXISTS ThumbnailLastUsedIndex "
+        "ON ThumbnailTable (LastUsed)"
+    )
 
     try:
         db_cursor = db_connection.cursor()
+        # hold the write lock from the version check until the tables
+        # are ready, so that only one process migrates them
+        db_cursor.execute("BEGIN IMMEDIATE")
+        migrateTables(db_cursor)
+        db_cursor.execute(sql_create_table)
+        if not hasIndex(db_cursor, "HashValueIndex"):
+            # databases from before the index (or written by an older
+            # version since) can hold doubles that block the index
+            compactHashTable(db_connection, commit=False)
+        db_cursor.execute(sql_create_index)
+        db_cursor.execute(sql_create_stat_table)
+        db_cursor.execute(sql_create_metadata_table)
+        db_cursor.execute(sql_create_thumbnail_table)
+        db_cursor.execute(sql_create_thumbnail_index)
         if clear:
             db_cursor.execute(sql_delete_table)
-            db_connection.execute("VACUUM")
-        db_cursor.execute(sql_create_table)
+            db_cursor.execute(sql_delete_stat_table)
+            db_cursor.execute(sql_delete_metadata_table)
+            db_cursor.execute(sql_delete_thumbnail_table)
 
         db_cursor.close()
         db_connection.commit()
         return True
     except sqlite3.Error:
+        db_connection.rollback()
         return False
 
 
 def closeConnection(db_connection):
     try:
-        db_connection.commit()
-        db_connection.execute("VACUUM")
+        maintainDatabase(db_connection)
+    except sqlite3.Error:
+        pass
+    finally:
         db_connection.close()
+
+
+def setHash(checksumHashTuples, hashname, algorithm="sha1", db_connection=None, commit=True):
+
+    if not checksumHashTuples:
+        return
+
+    tupled_data = [
+        (checksum, hashname, bytes(imagehashvalue), algorithm)
+        for checksum, imagehashvalue in checksumHashTuples
+    ]
+
+    db_cursor = db_connection.cursor()
+    db_cursor.executemany(
+        "INSERT INTO HashValueTable "
+        "(FileHash, HashMethod, ImageHashValue, FileHashAlgorithm) VALUES(?, ?, ?, ?) "
+        "ON CONFLICT (FileHash, HashMethod, FileHashAlgorithm) "
+        "DO UPDATE SET ImageHashValue=excluded.ImageHashValue",
+        tupled_data
+    )
+    db_cursor.close()
+    if commit:
+        db_connection.commit()
+
+
+def getHashes(checksums, hashname=None, algorithm="sha1", db_connection=None):
+    """return a dict with the stored hash values of each checksum:
+    checksum:{hashname: hashvalue (bytes)}
+    for all methods or only for hashname"""
+
+    hashDict = {}
+    checksums = list(checksums)
+    methods = [hashname] if hashname else []
+    try:
+        db_cursor = db_connection.cursor()
+        for chunk in chunks(checksums):
+            db_cursor.execute(
+                "SELECT FileHash, HashMethod, ImageHashValue FROM HashValueTable "
+                f"WHERE FileHashAlgorithm=? {'AND HashMethod=? ' if hashname else ''}"
+                f"AND FileHash IN ({','.join('?'*len(chunk))})",
+                [algorithm] + methods + chunk
+            )
+            for checksum, method, hashvalue in db_cursor.fetchall():
+                hashDict.setdefault(checksum, {})[method] = hashvalue
+        db_cursor.close()
+    except sqlite3.Error:
+        db_cursor.close()
+    return hashDict
+
+
+def setHashes(checksumHashnameHashTuples, algorithm="sha1", db_connection=None, commit=True):
+    """store (checksum, hashname, hashvalue) tuples of any hash method.
+    Like the other set functions, with commit=False the writes are left
+    in the open transaction to be committed together with later ones."""
+
+    if not checksumHashnameHashTuples:
+        return
+
+    tupled_data = [
+        (checksum, hashname, bytes(imagehashvalue), algorithm)
+        for checksum, hashname, imagehashvalue in checksumHashnameHashTuples
+    ]
+
+    db_cursor = db_connection.cursor()
+    db_cursor.executemany(
+        "INSERT INTO HashValueTable "
+        "(FileHash, HashMethod, ImageHashValue, FileHashAlgorithm) VALUES(?, ?, ?, ?) "
+        "ON CONFLICT (FileHash, HashMethod, FileHashAlgorithm) "
+        "DO UPDATE SET ImageHashValue=excluded.ImageHashValue",
+        tupled_data
+    )
+    db_cursor.close()
+    if commit:
+        db_connection.commit()
+
+
+def chunks(lst, size=500):
+    """yield successive parts of lst, to stay below
+    the maximum number of variables in one sql statement"""
+    for i in range(0, len(lst), size):
+        yield lst[i:i+size]
+
+
+def getFileChecksums(fileStatDict, algorithm="sha1", db_connection=None):
+    """return a dict with the stored checksum of each file in fileStatDict
+    (path:(size, mtime_ns, inode)) that did not change on disk since
+    the checksum was calculated."""
+
+    checksumDict = {}
+    paths = list(fileStatDict)
+    try:
+        db_cursor = db_connection.cursor()
+        for chunk in chunks(paths):
+            db_cursor.execute(
+                "SELECT FilePath, FileSize, FileMtime, FileInode, FileHash "
+                "FROM FileStatTable WHERE FileHashAlgorithm=? AND FilePath IN "
+                f"({','.join('?'*len(chunk))})",
+                [algorithm] + chunk
+            )
+            for path, size, mtime, inode, checksum in db_cursor.fetchall():
+                if fileStatDict[path] == (size, mtime, inode):
+                    checksumDict[path] = checksum
+        db_cursor.close()
     except sqlite3.Error:
+        db_cursor.close()
+    return checksumDict
+
+
+def setFileChecksums(fileStatChecksumTuples, algorithm="sha1", db_connection=None, commit=True):
+    """store (path, (size, mtime_ns, inode), checksum) tuples"""
+
+    if not fileStatChecksumTuples:
         return
 
+    tupled_data = [
+        (path, algorithm, size, mtime, inode, checksum)
+        for path, (size, mtime, inode), checksum in fileStatChecksumTuples
+    ]
+
+    db_cursor = db_connection.cursor()
+    db_cursor.executemany(
+        "INSERT OR REPLACE INTO FileStatTable "
+        "(FilePath, FileHashAlgorithm, FileSize, FileMtime, FileInode, FileHash) "
+        "VALUES(?, ?, ?, ?, ?, ?)",
+        tupled_data
+    )
+    db_cursor.close()
+    if commit:
+        db_connection.commit()
+
+
+def getMetadata(checksums, algorithm="sha1", db_connection=None):
+    """return a dict with the stored metadata of each checksum:
+    checksum:((width, height), make, model, timestamp)
+    The size is None for files that are not images."""
 
-def getHash(checksum, hashname, db_connection=None):
+    metadataDict = {}
+    checksums = list(checksums)
     try:
         db_cursor = db_connection.cursor()
+        for chunk in chunks(checksums):
+            db_cursor.execute(
+                "SELECT FileHash, Width, Height, Make, Model, DateTime "
+                "FROM FileMetadataTable WHERE FileHashAlgorithm=? AND FileHash IN "
+                f"({','.join('?'*len(chunk))})",
+                [algorithm] + chunk
+            )
+            for checksum, width, height, make, model, timestamp in db_cursor.fetchall():
+                size = None if width is None else (width, height)
+                metadataDict[checksum] = (size, make, model, timestamp)
+        db_cursor.close()
+    except sqlite3.Error:
+        db_cursor.close()
+    return metadataDict
+
+
+def setMetadata(checksumMetadataTuples, algorithm="sha1", db_connection=None, commit=True):
+    """store (checksum, ((width, height), make, model, timestamp)) tuples"""
+
+    if not checksumMetadataTuples:
+        return
+
+    tupled_data = [
+        (checksum, algorithm, *(size if size else (None, None)), make, model, timestamp)
+        for checksum, (size, make, model, timestamp) in checksumMetadataTuples
+    ]
+
+    db_cursor = db_connection.cursor()
+    db_cursor.executemany(
+        "INSERT OR REPLACE INTO FileMetadataTable "
+        "(FileHash, FileHashAlgorithm, Width, Height, Make, Model, DateTime) "
+        "VALUES(?, ?, ?, ?, ?, ?, ?)",
+        tupled_data
+    )
+    db_cursor.close()
+    if commit:
+        db_connection.commit()
+
+
+def deleteMetadata(checksums, algorithm="sha1", db_connection=None, commit=True):
+    "forget the stored metadata of checksums"
+
+    checksums = list(checksums)
+    db_cursor = db_connection.cursor()
+    for chunk in chunks(checksums):
         db_cursor.execute(
-            "SELECT ImageHashValue FROM HashValueTable WHERE FileHash=? AND HashMethod=?",
-            (checksum, hashname)
+            "DELETE FROM FileMetadataTable WHERE FileHashAlgorithm=? AND FileHash IN "
+            f"({','.join('?'*len(chunk))})",
+            [algorithm] + chunk
         )
-        hashvalue = db_cursor.fetchone()
+    db_cursor.close()
+    if commit:
+        db_connection.commit()
+
+
+def getThumbnails(checksums, thumbParams, algorithm="sha1", db_connection=None):
+    """return a dict with the stored (encoded) thumbnail of each checksum
+    made with thumbParams (thumbsize, channel, upscale)"""
+
+    thumbDict = {}
+    checksums = list(checksums)
+    thumbSize, channel, upscale = thumbParams
+    try:
+        db_cursor = db_connection.cursor()
+        for chunk in chunks(checksums):
+            db_cursor.execute(
+                "SELECT FileHash, Thumbnail FROM ThumbnailTable "
+                "WHERE FileHashAlgorithm=? AND ThumbSize=? AND Channel=? AND Upscale=? "
+                f"AND FileHash IN ({','.join('?'*len(chunk))})",
+                [algorithm, thumbSize, channel, int(upscale)] + chunk
+            )
+            thumbDict.update(db_cursor.fetchall())
         db_cursor.close()
-        if hashvalue:
-            # return convDict[hashname](hashvalue[0])
-            return HF.hexstring2array(hashvalue[0])
     except sqlite3.Error:
         db_cursor.close()
-    return None
+    return thumbDict
 
 
-def setHash(checksumHashTuples, hashname, db_connection=None):
+def touchThumbnails(checksums, thumbParams, algorithm="sha1", db_connection=None, commit=True):
+    "mark the stored thumbnails of checksums as recently used"
 
-    if not checksumHashTuples:
+    thumbSize, channel, upscale = thumbParams
+    now = int(time.time())
+    db_cursor = db_connection.cursor()
+    db_cursor.executemany(
+        "UPDATE ThumbnailTable SET LastUsed=? "
+        "WHERE FileHash=? AND FileHashAlgorithm=? AND ThumbSize=? AND Channel=? AND Upscale=?",
+        [(now, c, algorithm, thumbSize, channel, int(upscale)) for c in checksums]
+    )
+    db_cursor.close()
+    if commit:
+        db_connection.commit()
+
+
+def setThumbnails(checksumThumbTuples, thumbParams, algorithm="sha1", db_connection=None, commit=True):
+    """store (checksum, encoded thumbnail) tuples made with thumbParams
+    (thumbsize, channel, upscale)"""
+
+    if not checksumThumbTuples:
         return
 
+    thumbSize, channel, upscale = thumbParams
+    now = int(time.time())
     tupled_data = [
-        (checksum, hashname, HF.array2hexstring(imagehashvalue))
-        for checksum, imagehashvalue in checksumHashTuples
+        (checksum, algorithm, thumbSize, channel, int(upscale), thumb, now)
+        for checksum, thumb in checksumThumbTuples
     ]
 
     db_cursor = db_connection.cursor()
     db_cursor.executemany(
-        "INSERT INTO HashValueTable (FileHash, HashMethod, ImageHashValue) VALUES(?, ?, ?)",
+        "INSERT OR REPLACE INTO ThumbnailTable "
+        "(FileHash, FileHashAlgorithm, ThumbSize, Channel, Upscale, Thumbnail, LastUsed) "
+        "VALUES(?, ?, ?, ?, ?, ?, ?)",
         tupled_data
     )
     db_cursor.close()
-    db_connection.commit()
+    if commit:
+        db_connection.commit()
+
+
+def evictThumbnails(maxBytes, db_connection=None, commit=True):
+    """remove the least recently used thumbnails until the stored
+    thumbnails take at most maxBytes"""
+
+    db_cursor = db_connection.cursor()
+    db_cursor.execute("SELECT TOTAL(LENGTH(Thumbnail)) FROM ThumbnailTable")
+    excess = db_cursor.fetchone()[0] - maxBytes
+    if excess <= 0:
+        db_cursor.close()
+        return
+
+    rowids = []
+    db_cursor.execute(
+        "SELECT rowid, LENGTH(Thumbnail) FROM ThumbnailTable ORDER BY LastUsed"
+    )
+    for rowid, length in db_cursor:
+        if excess <= 0:
+            break
+        rowids.append(rowid)
+        excess -= length
+
+    for chunk in chunks(rowids):
+        db_cursor.execute(
+            f"DELETE FROM ThumbnailTable WHERE rowid IN ({','.join('?'*len(chunk))})",
+            chunk
+        )
+    db_cursor.close()
+    if commit:
+        db_connection.commit()
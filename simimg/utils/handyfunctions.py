@@ -4,16 +4,34 @@ import os
 import shutil
 
 
-def hexstring2array(hexstring):
-    """convert a hexstring to an array
-    (each pair of letters represents one element) <255"""
-    return [int(hexstring[i:i+2], 16) for i in range(0, len(hexstring), 2)]
+def popcount(number):
+    "number of 1 bits of a non-negative int"
+    return bin(number).count("1")
 
 
-def array2hexstring(array):
-    """convert an array to a hexstring
-    (each pair of letters represents one element)"""
-    return "".join(format(round(i), "x").zfill(2) for i in array)
+# int.bit_count is much faster but needs python 3.10
+if hasattr(int, "bit_count"):
+    popcount = int.bit_count
+
+
+def hashStream(afile, hasher, bufsize=1 << 20):
+    """feed the rest of the open file afile to hasher in chunks of bufsize
+    bytes. One buffer is reused for all chunks so that the memory use
+    does not depend on the size of the file."""
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    while True:
+        nread = afile.readinto(buf)
+        if not nread:
+            break
+        hasher.update(view[:nread])
+    return hasher
+
+
+def hashFile(file, hasher, bufsize=1 << 20):
+    "feed the content of file to hasher in chunks of bufsize bytes"
+    with open(file, "rb", buffering=0) as afile:
+        return hashStream(afile, hasher, bufsize=bufsize)
 
 
 def pairlist2dict(lst):
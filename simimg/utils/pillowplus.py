@@ -1,23 +1,48 @@
 """ Some some utililty for reading and dealing with pillow images"""
+import io
+
 from PIL import Image, ImageTk, ImageChops
 
 pillowplus_table16 = [i/256 for i in range(65536)]
 
+# reduced images are kept at least this factor larger than requested
+# so that the final resize still has enough pixels to average
+reducingGap = 2
+
 
-def imageOpen(fn):
+def imageOpen(fn, draftSize=None):
+    """open an image file. With draftSize (w, h) the image may be
+    decoded/reduced to a smaller size that still covers draftSize"""
     try:
         img = Image.open(fn)
+        if draftSize:
+            # JPEGs are decoded at the smallest DCT scale that fits
+            img.draft(None, (draftSize[0]*reducingGap, draftSize[1]*reducingGap))
         if (
                 img.format == "PNG" and
                 img.mode == "I" and
                 max(img.getdata()) > 255
         ):
             img = img.point(pillowplus_table16, "L")
+        if draftSize:
+            img = imageReduce(img, draftSize[0], draftSize[1])
     except:
         return None
     return img
 
 
+def imageReduce(img, w, h):
+    "reduce the image by an integer factor while it still covers w, h"
+    factor = min(img.size[0]//(w*reducingGap), img.size[1]//(h*reducingGap))
+    if factor < 2:
+        return img
+    try:
+        return img.reduce(factor)
+    except ValueError:
+        # not all modes can be reduced
+        return img
+
+
 def imageResize(img, w, h):
     try:
         res = img.resize((w, h), Image.Resampling.LANCZOS)
@@ -65,11 +90,15 @@ def photoImageOpenAndResizeToFit(fn, w, h):
     return TkPhotoImage(img)
 
 
-def thumbnailOpen(fn, w, h, channel=None, upscale=False):
-    img = imageOpen(fn)
+def thumbnailOpen(fn, w, h, channel=None, upscale=False, reduced=False):
+    img = imageOpen(fn, draftSize=(w, h) if reduced else None)
     if not img:
         return None
+    return thumbnailMake(img, w, h, channel=channel, upscale=upscale)
+
 
+def thumbnailMake(img, w, h, channel=None, upscale=False):
+    "make the thumbnail of an opened image (in place if possible)"
     try:
         # this is needed because thumbnail does not check that the file can
         # be actually loaded
@@ -112,8 +141,35 @@ def thumbnailOpen(fn, w, h, channel=None, upscale=False):
     return img
 
 
-def photoThumbnailOpen(fn, w, h, channel=None, upscale=False):
-    img = thumbnailOpen(fn, w, h, channel=channel, upscale=upscale)
+def photoThumbnailOpen(fn, w, h, channel=None, upscale=False, reduced=False):
+    img = thumbnailOpen(fn, w, h, channel=channel, upscale=upscale, reduced=reduced)
     if not img:
         return None
     return TkPhotoImage(img)
+
+
+def thumbnailEncode(img):
+    """return the thumbnail as bytes for storing it on disk.
+    JPEG for photos, PNG for the rest. HSV thumbnails are stored in the
+    RGB colours they are shown with."""
+    if img.mode == "HSV":
+        img = img.convert("RGB")
+    buffer = io.BytesIO()
+    try:
+        if img.mode in ("RGB", "L"):
+            img.save(buffer, format="JPEG", quality=90)
+        else:
+            img.save(buffer, format="PNG")
+    except (OSError, ValueError, KeyError):
+        return None
+    return buffer.getvalue()
+
+
+def thumbnailDecode(data):
+    "return the thumbnail stored as bytes by thumbnailEncode"
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.load()
+    except:
+        return None
+    return img
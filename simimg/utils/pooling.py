@@ -1,15 +1,24 @@
 """Functions on the image files that take time. Like file-hashing and
 image-hashing They are organised to be done in multiprocessing.
 
+The pool of worker processes is created once (createPool) and passed to
+the functions that need it, like the DataBase connection.
 """
-import functools
+import calendar
 import hashlib
+import os
+import time
 from multiprocessing import Pool
-from operator import add
 
-from PIL import Image
+from PIL import ExifTags, Image
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 import simimg.utils.database as DB
+import simimg.utils.handyfunctions as HF
 import simimg.utils.pillowplus as PP
 
 # box that contains the whole image
@@ -39,22 +48,324 @@ def statsQuantiles(a):
     return [aa[round(len(aa)*i)] for i in [0.25, 0.5, 0.75]]
 
 
-def calculateChecksum(file):
-    hasher = hashlib.sha1()
-    with open(file, "rb") as afile:
-        hasher.update(afile.read())
+def initWorker():
+    "Prepare a new worker process: load all the pillow image plugins"
+    Image.init()
+
+
+def createPool(processes=None):
+    """Create a pool of worker processes that lives for the whole session.
+    processes=None (or 0) uses one worker per cpu."""
+    return Pool(processes=processes or None, initializer=initWorker)
+
+
+def closePool(pool):
+    pool.close()
+    pool.join()
+
+
+def terminatePool(pool):
+    "Stop a pool without finishing the tasks it still has queued"
+    pool.terminate()
+    pool.join()
+
+
+def poolResults(pool, func, args, progress=None):
+    """yield the results of func over args from pool as soon as they are
+    ready (in any order). Use a temporary pool if there is none.
+
+    progress(done, total) is called before the first and after each
+    result. If it returns True the remaining results are abandoned. The
+    tasks that are still queued keep the pool busy, so the pool should
+    be terminated after cancelling."""
+    total = len(args)
+    if not total or (progress and progress(0, total)):
+        return
+    # a few chunks per worker: small enough to report progress
+    # often, large enough to limit the communication overhead
+    chunksize = max(1, min(64, total // (8 * (os.cpu_count() or 1))))
+    if pool is None:
+        with Pool(initializer=initWorker) as tmppool:
+            yield from poolResults(tmppool, func, args, progress=progress)
+        return
+    for done, result in enumerate(pool.imap_unordered(func, args, chunksize), start=1):
+        yield result
+        if progress and progress(done, total):
+            return
+
+
+def storeInDatabase(writes, db_connection=None, db_writer=None):
+    """store a list of (DB function, args, kwargs) writes in one
+    transaction, in the background if there is a db_writer"""
+    if db_writer is not None:
+        db_writer.submit(writes)
+    else:
+        DB.writeBatch(writes, db_connection)
+
+
+def poolBatches(pool, func, args, progress=None, batchsize=256):
+    """yield the results of poolResults in lists of up to batchsize, so
+    that they can be stored while the remaining results are calculated"""
+    batch = []
+    for result in poolResults(pool, func, args, progress=progress):
+        batch.append(result)
+        if len(batch) >= batchsize:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def calculateChecksum(args):
+    file, algorithm = args
+    try:
+        hasher = HF.hashFile(file, hashlib.new(algorithm))
+    except OSError:
+        return (file, None)
     return (file, hasher.hexdigest())
 
 
-def getChecksums(filelist, hashValueDict):
-    """return checksum hashing value for each file the list."""
+def hashJpegImageData(afile, hasher):
+    """feed the segments of the open jpeg file afile to hasher, leaving out
+    the application (APPn) and comment segments that hold the metadata.
+    Return False if the file does not look like a jpeg file."""
+    if afile.read(2) != b"\xff\xd8":
+        return False
+    while True:
+        marker = afile.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return False
+        # markers without a segment
+        if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD7:
+            hasher.update(marker)
+            continue
+        if marker[1] == 0xD9:
+            return True
+        length = afile.read(2)
+        if len(length) < 2:
+            return False
+        segment = afile.read(int.from_bytes(length, "big") - 2)
+        if not (0xE0 <= marker[1] <= 0xEF or marker[1] == 0xFE):
+            hasher.update(marker)
+            hasher.update(length)
+            hasher.update(segment)
+        # start of scan: the compressed image data follow until the end
+        if marker[1] == 0xDA:
+            HF.hashStream(afile, hasher)
+            return True
+
+
+def calculateImageDataChecksum(args):
+    """return a checksum of the image data only, so that it does not change
+    when only the metadata of the file are rewritten. For jpeg files these
+    are the compressed image data, for other images the decoded pixels.
+    Files that are not images are hashed completely."""
+    file, algorithm = args
+    try:
+        with open(file, "rb") as afile:
+            hasher = hashlib.new(algorithm)
+            if hashJpegImageData(afile, hasher):
+                return (file, hasher.hexdigest())
+    except OSError:
+        return (file, None)
+
+    img = PP.imageOpen(file)
+    if img is None:
+        return calculateChecksum((file, algorithm))
+    try:
+        hasher = hashlib.new(algorithm)
+        hasher.update(f"{img.mode} {img.size}".encode())
+        hasher.update(img.tobytes())
+    except:
+        return calculateChecksum((file, algorithm))
+    return (file, hasher.hexdigest())
+
+
+def checksumAlgorithmName(algorithm, imageDataOnly=False):
+    "name under which checksums made with these options are stored"
+    if imageDataOnly:
+        return f"{algorithm}-imagedata"
+    return algorithm
+
+
+def fileStat(file):
+    "return the (size, mtime_ns, inode) that identify the state of a file"
+    st = os.stat(file)
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def getChecksums(
+        filelist,
+        hashValueDict,
+        algorithm="sha1",
+        imageDataOnly=False,
+        db_connection=None,
+        db_writer=None,
+        pool=None,
+        progress=None
+):
+    """return checksum hashing value (with the hashlib algorithm)
+    for each file the list.
+
+    Files that no longer exist get no checksum. Files that did not
+    change on disk since their checksum was stored in the database take
+    the stored value. New and changed files are
+    hashed completely, the checksum is the key of all data stored about
+    the file.
+
+    With imageDataOnly the checksum covers only the image data
+    (calculateImageDataChecksum).
+
+    The checksums are stored as they arrive, if the calculation is
+    cancelled (see poolResults) the checksums found so far are kept."""
+    algorithmName = checksumAlgorithmName(algorithm, imageDataOnly)
+    # files that were deleted or moved since they got their checksum
+    # are left out, their data would come from the database
+    for file in set(filelist) & set(hashValueDict):
+        if not os.path.isfile(file):
+            del hashValueDict[file]
     missingfilelist = list(set(filelist) - set(hashValueDict.keys()))
-    with Pool() as pool:
-        calculatedHashes = pool.map(calculateChecksum, missingfilelist)
-    hashValueDict.update(calculatedHashes)
+
+    fileStatDict = {}
+    for file in missingfilelist:
+        try:
+            fileStatDict[file] = fileStat(file)
+        except OSError:
+            continue
+
+    storedHashes = DB.getFileChecksums(
+        fileStatDict,
+        algorithm=algorithmName,
+        db_connection=db_connection
+    )
+    hashValueDict.update(storedHashes)
+
+    def storeChecksums(calculatedHashes):
+        calculatedHashes = [(f, c) for f, c in calculatedHashes if c is not None]
+        hashValueDict.update(calculatedHashes)
+        writes = []
+        # the metadata of a file can change without changing its image data
+        if imageDataOnly:
+            writes.append((
+                DB.deleteMetadata,
+                ([checksum for file, checksum in calculatedHashes],),
+                {"algorithm": algorithmName}
+            ))
+        writes.append((
+            DB.setFileChecksums,
+            ([(file, fileStatDict[file], checksum) for file, checksum in calculatedHashes],),
+            {"algorithm": algorithmName}
+        ))
+        storeInDatabase(writes, db_connection=db_connection, db_writer=db_writer)
+
+    missingfilelist = [
+        (file, algorithm)
+        for file in fileStatDict if file not in hashValueDict
+    ]
+    for calculatedHashes in poolBatches(
+            pool,
+            calculateImageDataChecksum if imageDataOnly else calculateChecksum,
+            missingfilelist,
+            progress=progress
+    ):
+        storeChecksums(calculatedHashes)
+
     return hashValueDict
 
 
+def exifTimestamp(date):
+    """convert an exif date string to seconds since the epoch (of the
+    local clock time of the camera) or None if there is no valid date"""
+    try:
+        return calendar.timegm(time.strptime(date, "%Y:%m:%d %H:%M:%S"))
+    except (TypeError, ValueError):
+        return None
+
+
+def probeImage(file):
+    """return a compact record with the information of an image file
+    (file, (width, height), make, model, timestamp) or
+    (file, None, "", "", None) if it cannot be read as an image."""
+    try:
+        img = Image.open(file)
+    except:
+        return (file, None, "", "", None)
+
+    with img:
+        exifTags = {
+            "Make": "",
+            "Model": "",
+            "DateTimeOriginal": "",
+            "DateTime": "",
+            "DateTimeDigitized": ""
+        }
+        try:
+            # not all images have a method to get tags
+            exif = img._getexif() if hasattr(img, "_getexif") else None
+        except:
+            exif = None
+        if exif:
+            for key, value in exif.items():
+                if key in ExifTags.TAGS and ExifTags.TAGS[key] in exifTags:
+                    exifTags[ExifTags.TAGS[key]] = str(value)
+        date = (
+            exifTags["DateTimeOriginal"] or
+            exifTags["DateTime"] or
+            exifTags["DateTimeDigitized"]
+        )
+        return (
+            file,
+            img.size,
+            exifTags["Make"],
+            exifTags["Model"],
+            exifTimestamp(date)
+        )
+
+
+def getProbes(
+        filelist,
+        checksumDict,
+        algorithm="sha1",
+        db_connection=None,
+        db_writer=None,
+        pool=None,
+        progress=None
+):
+    """return a dict with the probeImage record of each image file in
+    filelist. The records are stored in the database by checksum, only
+    files with a checksum that was never seen before are probed."""
+    metadataDict = DB.getMetadata(
+        {checksumDict[file] for file in filelist},
+        algorithm=algorithm,
+        db_connection=db_connection
+    )
+
+    probeDict = {}
+    missingfilelist = []
+    for file in filelist:
+        checksum = checksumDict[file]
+        if checksum in metadataDict:
+            probeDict[file] = (file, *metadataDict[checksum])
+        else:
+            missingfilelist.append(file)
+
+    for records in poolBatches(pool, probeImage, missingfilelist, progress=progress):
+        probeDict.update((record[0], record) for record in records)
+        storeInDatabase(
+            [(
+                DB.setMetadata,
+                ([(checksumDict[record[0]], record[1:]) for record in records],),
+                {"algorithm": algorithm}
+            )],
+            db_connection=db_connection,
+            db_writer=db_writer
+        )
+
+    return {
+        file: record for file, record in probeDict.items() if record[1] is not None
+    }
+
+
 def subImage(Img, FracBox):
     "return a subImage from Image based on coordinates in dimensionless units"
     width, height = Img.size
@@ -80,6 +391,9 @@ def colorHash(Img, colorspace=None, five=False):
     # resample to speed up the calculation
     Img = Img.resize((100, 100), Image.BOX)
 
+    if np is not None:
+        return colorHashArray(Img, cspace, boxes)
+
     # split in bands
     channels = [ch.getdata() for ch in Img.split()]
 
@@ -102,6 +416,37 @@ def colorHash(Img, colorspace=None, five=False):
     return values
 
 
+def colorHashArray(Img, cspace, boxes):
+    """ colorHash with numpy: the same values from one array of the image
+    using np.partition at the indices that statsQuantiles takes """
+    arr = np.asarray(Img)
+    if arr.ndim == 2:
+        arr = arr[:, :, np.newaxis]
+    width, height = Img.size
+
+    values = []
+    for bx in boxes:
+        left = round(width*bx[0])
+        right = round(width*bx[2])
+        bottom = round(height*bx[1])
+        top = round(height*bx[3])
+        data = arr[bottom:top, left:right].reshape(-1, arr.shape[2])
+        q = [round(len(data)*i) for i in [0.25, 0.5, 0.75]]
+        # the quantiles of all channels at once
+        quant = np.partition(data, q, axis=0)[q].astype(int)
+        for idx in range(arr.shape[2]):
+            if cspace == "HSV" and idx == 1:
+                medianH = int(quant[1, idx])
+                wrapped = (data[:, idx].astype(int) - medianH + 128) % 255
+                wquant = np.partition(wrapped, [q[0], q[2]])
+                values.append(medianH)
+                values.append(int(wquant[q[2]] - wquant[q[0]]))
+            else:
+                values.append(int(quant[1, idx]))
+                values.append(int(quant[2, idx] - quant[0, idx]))
+    return values
+
+
 def hsvHash(Img):
     return colorHash(Img, colorspace="HSV", five=False)
 
@@ -127,19 +472,25 @@ def l5Hash(Img):
 
 
 def dHash(Img, doVertical=False):
+    """difference hash: for each of the 8 rows of a 9x8 image 8 bits that
+    tell if the next pixel is brighter. Packed as one 64-bit number (row 0
+    in the lowest byte, pixel 0 in the lowest bit), returned as its
+    8 little endian bytes"""
     if doVertical:
         i8x8 = Img.convert("L").resize((8, 9), Image.BOX).transpose(Image.ROTATE_90)
     else:
         i8x8 = Img.convert("L").resize((9, 8), Image.BOX)
 
-    values = []
-    for y in range(8):
-        val = functools.reduce(
-            add,
-            [(i8x8.getpixel((x+1, y)) > i8x8.getpixel((x, y)))*(2**x) for x in range(8)]
-        )
-        values.append(val)
-    return values
+    if np is not None:
+        pixels = np.asarray(i8x8)
+        brighter = pixels[:, 1:] > pixels[:, :-1]
+        return np.packbits(brighter, axis=1, bitorder="little").tobytes()
+
+    pixels = i8x8.tobytes()
+    return bytes(
+        sum((pixels[9*y+x+1] > pixels[9*y+x]) << x for x in range(8))
+        for y in range(8)
+    )
 
 
 def dHashHorizontal(Img):
@@ -150,93 +501,237 @@ def dHashVertical(Img):
     return dHash(Img, doVertical=True)
 
 
-def calculateHash(args):
-    checksum, fullPath, hashName = args
-    funcdict = {
-        "HSV": hsvHash,
-        "HSV (5 regions)": hsv5Hash,
-        "RGB": rgbHash,
-        "RGB (5 regions)": rgb5Hash,
-        "Luminosity": lHash,
-        "Luminosity (5 regions)": l5Hash,
-        "Horizontal": dHashHorizontal,
-        "Vertical": dHashVertical,
-    }
-    return (checksum, funcdict[hashName](PP.imageOpen(fullPath)))
+# all hash methods, these are made when indexing the images
+hashFunctions = {
+    "HSV": hsvHash,
+    "HSV (5 regions)": hsv5Hash,
+    "RGB": rgbHash,
+    "RGB (5 regions)": rgb5Hash,
+    "Luminosity": lHash,
+    "Luminosity (5 regions)": l5Hash,
+    "Horizontal": dHashHorizontal,
+    "Vertical": dHashVertical,
+}
 
+# the hashes are made from images of at most 100x100 pixels
+hashDraftSize = (100, 100)
 
-def getHashes(FODict, hashName, db_connection=None):
-    """return hashing value according to selected hashName method
-    for each file the (file,checksum) list."""
 
-    # create an empty dict to hold the results
-    hashValueDict = {} # checksum:hashValue
-
-    # create an empty list to hold checksum,file,hashName tuples
+def calculateHash(args):
+    row, fullPath, hashName, reduced = args
+    img = PP.imageOpen(fullPath, draftSize=hashDraftSize if reduced else None)
+    if img is None:
+        return (row, None)
+    try:
+        return (row, hashFunctions[hashName](img))
+    except:
+        # for example a mode that cannot be converted
+        return (row, None)
+
+
+def getHashes(
+        Catalogue,
+        FODict,
+        hashName,
+        algorithm="sha1",
+        reduced=False,
+        db_connection=None,
+        db_writer=None,
+        pool=None,
+        progress=None
+):
+    """make sure the Catalogue has the hash value according to the
+    selected hashName method for each checksum in FODict. The checksums
+    are made with the file hash algorithm."""
+
+    # create an empty list to hold row,file,hashName,reduced tuples
     # that need to be calculated
     needCalculating = []
 
-    # for each uniq checksum in the requested file in FODict
-    # check if the FileObject has the hash value already list.
-    # if yes take it
-    #
-    # if none:
-    # get the hash value for this method and this checksum from the database or None
-    #
-    # if none add the info to the needCalculating list
-
-    for checksum, fileObjectList in FODict.items():
-        firstFO = fileObjectList[0]
-        if hashName in firstFO.hashDict:
-            hashValueDict[checksum] = firstFO.hashDict[hashName]
-            continue
-
-        hashValue = DB.getHash(checksum, hashName, db_connection=db_connection)
-        if hashValue is None:
-            needCalculating.append((checksum, firstFO.fullPath, hashName))
+    # the rows that the Catalogue does not have the hash value of
+    # are looked up in the database all at once.
+    # The ones that are not there are added to the needCalculating list
+    rows = [
+        row for row in Catalogue.rows(FODict)
+        if not Catalogue.hasHash(hashName, row) and not Catalogue.hashFailed(hashName, row)
+    ]
+    storedHashes = DB.getHashes(
+        [Catalogue.checksums[row] for row in rows],
+        hashname=hashName,
+        algorithm=algorithm,
+        db_connection=db_connection
+    )
+    for row in rows:
+        checksum = Catalogue.checksums[row]
+        if checksum in storedHashes:
+            Catalogue.setHash(hashName, row, storedHashes[checksum][hashName])
         else:
-            hashValueDict[checksum] = hashValue
-
-    # For the checksum with None calculate the hashValue in a pool of workers
-    # Returning (checksum, imagehash)
-    if needCalculating:
+            # a file that is shown now, the first one of a checksum
+            # can have been moved or deleted since
+            needCalculating.append(
+                (row, FODict[checksum][0].fullPath, hashName, reduced)
+            )
+
+    # For the rows with None calculate the hashValue in a pool of workers
+    # Returning (row, imagehash)
+    for calculatedHashes in poolBatches(
+            pool,
+            calculateHash,
+            needCalculating,
+            progress=progress
+    ):
+        # do not try the ones that failed again
+        for row, hashValue in calculatedHashes:
+            if hashValue is None:
+                Catalogue.setHashFailed(hashName, row)
+        calculatedHashes = [(r, h) for r, h in calculatedHashes if h is not None]
+        for row, hashValue in calculatedHashes:
+            Catalogue.setHash(hashName, row, hashValue)
+
+        # update the database with the new checksum, method, hashValue
+        storeInDatabase(
+            [(
+                DB.setHash,
+                (
+                    [(Catalogue.checksums[row], hashValue) for row, hashValue in calculatedHashes],
+                    hashName
+                ),
+                {"algorithm": algorithm}
+            )],
+            db_connection=db_connection,
+            db_writer=db_writer
+        )
 
-        with Pool() as pool:
-            calculatedHashes = pool.map(calculateHash, needCalculating)
 
-        hashValueDict.update(calculatedHashes)
+def indexImage(arg):
+    """decode the image once and make its thumbnail and the requested hashes
+    returns (checksum, thumbnail, encoded thumbnail, {hashName: hash})"""
+    checksum, filename, tsize, channel, upscale, reduced, hashNames = arg
+    draftSize = None
+    if reduced:
+        draftSize = (max(tsize, hashDraftSize[0]), max(tsize, hashDraftSize[1]))
+    img = PP.imageOpen(filename, draftSize=draftSize)
+    if img is None:
+        return (checksum, None, None, {})
+    try:
+        img.load()
+    except:
+        return (checksum, None, None, {})
+
+    # the hashes first, the thumbnail is made in place.
+    # A hash that fails (for example for a mode that cannot be
+    # converted) is left out, like for files that cannot be opened
+    hashes = {}
+    for hashName in hashNames:
+        try:
+            hashes[hashName] = hashFunctions[hashName](img)
+        except:
+            continue
+    thumb = PP.thumbnailMake(img, tsize, tsize, channel=channel, upscale=upscale)
+    # also encode it for the thumbnail cache
+    return (checksum, thumb, PP.thumbnailEncode(thumb) if thumb else None, hashes)
+
+
+def indexImages(
+        Catalogue,
+        FODict,
+        Thumbsize=None,
+        channel="Default",
+        upscale=False,
+        reduced=False,
+        algorithm="sha1",
+        cacheSize=0,
+        db_connection=None,
+        db_writer=None,
+        pool=None,
+        progress=None
+):
+    """return thumbnail for each checksum in FODict and make sure that the
+    Catalogue has every hash in hashFunctions for them.
+
+    Known hashes are read from the database and the thumbnails are taken
+    from the cache in the database if possible. The images that still
+    need something are decoded only once to make the thumbnail and all
+    missing hashes. These are stored per batch, the thumbnail cache is
+    kept below cacheSize bytes by removing the least recently used ones.
+    If the calculation is cancelled only the thumbnails made so far."""
+    thumbParams = (Thumbsize, channel, upscale)
+    ThumbDict = {}
 
-        # update the database with the new checksum, method, hashValueDict
-        DB.setHash(calculatedHashes, hashName, db_connection=db_connection)
-
-    # write everything back to each fileobject
-    # every checksum key in the FODict contains a list of fileobjects
-    # that match this checksum
-    for checksum, hashValue in hashValueDict.items():
-        for FO in FODict[checksum]:
-            FO.hashDict[hashName] = hashValue
-
-
-def getOneThumb(arg):
-    checksum, filename, tsize, channel, upscale = arg
-    img = PP.thumbnailOpen(
-        filename,
-        tsize,
-        tsize,
-        channel=channel,
-        upscale=upscale
+    def missingHashes(checksum):
+        row = Catalogue.row(checksum)
+        return [
+            h for h in hashFunctions
+            if not Catalogue.hasHash(h, row) and not Catalogue.hashFailed(h, row)
+        ]
+
+    storedHashes = DB.getHashes(
+        [checksum for checksum in FODict if missingHashes(checksum)],
+        algorithm=algorithm,
+        db_connection=db_connection
     )
-    return (checksum, img)
-
+    for checksum, hashes in storedHashes.items():
+        row = Catalogue.row(checksum)
+        for hashName, hashValue in hashes.items():
+            if hashName in hashFunctions:
+                Catalogue.setHash(hashName, row, hashValue)
+
+    if cacheSize > 0:
+        cachedThumbs = DB.getThumbnails(
+            FODict,
+            thumbParams,
+            algorithm=algorithm,
+            db_connection=db_connection
+        )
+        for checksum, data in cachedThumbs.items():
+            img = PP.thumbnailDecode(data)
+            if img:
+                ThumbDict[checksum] = img
+        # keep them from being evicted
+        storeInDatabase(
+            [(DB.touchThumbnails, (list(cachedThumbs), thumbParams), {"algorithm": algorithm})],
+            db_connection=db_connection,
+            db_writer=db_writer
+        )
 
-def getThumbnails(FODict, Thumbsize=None, channel="Default", upscale=False):
-    """return thumbnail for each checksum in FODict."""
-    args = [
-        (checksum, fo[0].fullPath, Thumbsize, channel, upscale)
-        for checksum, fo in FODict.items()
-    ]
-    with Pool() as pool:
-        calculatedthumbs = pool.map(getOneThumb, args)
-    ThumbDict = {}
-    ThumbDict.update(calculatedthumbs)
+    args = []
+    for checksum, fo in FODict.items():
+        hashNames = missingHashes(checksum)
+        if checksum not in ThumbDict or hashNames:
+            args.append(
+                (checksum, fo[0].fullPath, Thumbsize, channel, upscale, reduced, hashNames)
+            )
+
+    for results in poolBatches(pool, indexImage, args, progress=progress):
+        newHashes = []
+        newThumbs = []
+        for checksum, thumb, data, hashes in results:
+            if thumb or checksum not in ThumbDict:
+                ThumbDict[checksum] = thumb
+            if data:
+                newThumbs.append((checksum, data))
+            row = Catalogue.row(checksum)
+            for hashName, hashValue in hashes.items():
+                Catalogue.setHash(hashName, row, hashValue)
+                newHashes.append((checksum, hashName, hashValue))
+            # the image was decoded, the hashes it lacks cannot be made
+            if thumb:
+                for hashName in hashFunctions:
+                    if not Catalogue.hasHash(hashName, row):
+                        Catalogue.setHashFailed(hashName, row)
+
+        # everything of this batch in one transaction
+        writes = [(DB.setHashes, (newHashes,), {"algorithm": algorithm})]
+        if cacheSize > 0:
+            writes.append(
+                (DB.setThumbnails, (newThumbs, thumbParams), {"algorithm": algorithm})
+            )
+        storeInDatabase(writes, db_connection=db_connection, db_writer=db_writer)
+
+    if cacheSize > 0 and args:
+        storeInDatabase(
+            [(DB.evictThumbnails, (cacheSize,), {})],
+            db_connection=db_connection,
+            db_writer=db_writer
+        )
     return ThumbDict
@@ -0,0 +1,142 @@
+""" Tests of the DataBase functions when it is shared: the transactions
+of writeBatch and the DatabaseWriter, and several processes that index
+into one DataBase at the same time (python -m pytest tests). """
+import multiprocessing
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import simimg.classes.databasewriter as DW
+import simimg.utils.database as DB
+import simimg.utils.pooling as POOL
+
+thumbParams = (100, "Default", False)
+
+
+def openDatabase(db_file):
+    db_connection = DB.createConnection(str(db_file))
+    assert DB.createTables(db_connection)
+    return db_connection
+
+
+def storedChecksums(db_connection):
+    return {
+        row[0] for row in db_connection.execute("SELECT FileHash FROM HashValueTable")
+    }
+
+
+def test_writebatch_stores_nothing_of_a_failed_batch(tmp_path):
+    db_connection = openDatabase(tmp_path / "simimg.db")
+    with pytest.raises(ValueError):
+        DB.writeBatch(
+            [
+                (DB.setHashes, ([("a", "dHash", b"12345678")],), {}),
+                # bytes([300]) raises a ValueError
+                (DB.setHashes, ([("b", "dHash", [300])],), {}),
+            ],
+            db_connection
+        )
+    DB.writeBatch([(DB.setHashes, ([("c", "dHash", b"12345678")],), {})], db_connection)
+    assert storedChecksums(db_connection) == {"c"}
+
+
+def test_writebatch_retries_while_busy(tmp_path):
+    db_file = tmp_path / "simimg.db"
+    openDatabase(db_file).close()
+    # another connection keeps the write lock for a while
+    locker = sqlite3.connect(str(db_file), check_same_thread=False)
+    locker.execute("BEGIN IMMEDIATE")
+    releaser = threading.Timer(0.5, locker.rollback)
+    releaser.start()
+
+    db_connection = sqlite3.connect(str(db_file), timeout=0.05)
+    DB.configureConnection(db_connection)
+    DB.writeBatch([(DB.setHashes, ([("a", "dHash", b"12345678")],), {})], db_connection)
+    releaser.join()
+    assert storedChecksums(db_connection) == {"a"}
+
+
+def test_databasewriter_reports_and_discards_a_failed_batch(tmp_path):
+    db_file = tmp_path / "simimg.db"
+    db_connection = openDatabase(db_file)
+    writer = DW.DatabaseWriter(str(db_file))
+    writer.submit([
+        (DB.setHashes, ([("a", "dHash", b"12345678")],), {}),
+        (DB.setHashes, ([("b", "dHash", [300])],), {}),
+    ])
+    with pytest.raises(ValueError):
+        writer.flush()
+    writer.submit([(DB.setHashes, ([("c", "dHash", b"12345678")],), {})])
+    writer.close()
+    assert storedChecksums(db_connection) == {"c"}
+
+
+def indexInto(db_file, workerId, nbatches, clearAt, results):
+    """ store batches of hashes, thumbnails and metadata of checksums
+    that partly overlap with the other workers, like an indexing job """
+    random.seed(workerId)
+    errors = []
+    try:
+        db_connection = DB.createConnection(db_file)
+        if not DB.createTables(db_connection):
+            errors.append("createTables failed")
+        writer = DW.DatabaseWriter(db_file)
+        for batch in range(nbatches):
+            checksums = [f"c{random.randrange(2000)}" for dummy in range(64)]
+            POOL.storeInDatabase(
+                [
+                    (DB.setHashes, ([(c, m, os.urandom(8)) for c in checksums for m in ("dHash", "HSV")],), {}),
+                    (DB.setThumbnails, ([(c, os.urandom(2000)) for c in checksums], thumbParams), {}),
+                    (DB.setMetadata, ([(c, ((10, 20), "make", "model", 5)) for c in checksums],), {}),
+                ],
+                db_connection=db_connection,
+                db_writer=writer
+            )
+            if batch % 5 == 0:
+                POOL.storeInDatabase([(DB.evictThumbnails, (2**20,), {})], db_writer=writer)
+            # reads meanwhile
+            DB.getHashes(checksums, db_connection=db_connection)
+            DB.getThumbnails(checksums, thumbParams, db_connection=db_connection)
+            if batch == clearAt:
+                writer.flush()
+                if not DB.createTables(db_connection, clear=True):
+                    errors.append("clearing failed")
+        writer.close()
+        DB.closeConnection(db_connection)
+    except Exception as error:
+        errors.append(repr(error))
+    results.put((workerId, errors))
+
+
+def test_several_processes_index_into_one_database(tmp_path):
+    db_file = str(tmp_path / "simimg.db")
+    nprocesses = 6
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=indexInto,
+            # the first one empties the DataBase halfway
+            args=(db_file, workerId, 20, 10 if workerId == 0 else -1, results)
+        )
+        for workerId in range(nprocesses)
+    ]
+    start = time.monotonic()
+    for process in processes:
+        process.start()
+    errors = dict(results.get(timeout=300) for dummy in processes)
+    for process in processes:
+        process.join()
+
+    assert errors == {workerId: [] for workerId in range(nprocesses)}
+    assert time.monotonic() - start < 300
+    db_connection = sqlite3.connect(db_file)
+    assert db_connection.execute("PRAGMA integrity_check").fetchone() == ("ok",)
+    rows, unique = db_connection.execute(
+        "SELECT COUNT(*), COUNT(DISTINCT FileHash || HashMethod || FileHashAlgorithm) "
+        "FROM HashValueTable"
+    ).fetchone()
+    assert rows == unique > 0